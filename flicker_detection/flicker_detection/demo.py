@@ -1,15 +1,23 @@
 import os
 import re
+import hashlib
+import time
 import tqdm
 import logging
 import torch
-import torchvision
 import numpy as np
 import pandas as pd
+import skvideo.io
 from argparse import ArgumentParser
 from mypyfunc.torch_models import CNN_Transformers
+from mypyfunc.backbones import BACKBONES, Backbone
+from mypyfunc.export import ARTIFACTS, RUNTIMES, load_runtime
 from mypyfunc.streamer import MultiStreamer, VideoDataSet
 from mypyfunc.logger import init_logger
+from mypyfunc.feature_cache import FeatureCache
+from mypyfunc.cascade import CascadeFilter
+from mypyfunc.localization import TemporalLocalizer
+from typing import Tuple
 
 
 def run(
@@ -19,6 +27,10 @@ def run(
     objective:torch.nn.Module,
     labels:dict,
     log_dir:str,
+    cache:FeatureCache=None,
+    cache_keys:dict=None,
+    predictions:dict=None,
+    cascade:CascadeFilter=None,
 )->None:
     logs = {
         'issue':[],
@@ -26,16 +38,37 @@ def run(
         'occur_sec':[],
         'log_message':[]
     }
+    predictions = dict(predictions or {})
+    n_windows, n_skipped = 0, 0
+    start_time = time.perf_counter()
     logging.info("streaming...")
-    for inputs,filename in tqdm.tqdm(stream):
+    for inputs,filename in tqdm.tqdm(stream if stream is not None else ()):
+        n_windows += inputs.shape[0]
+        if cascade is not None and cascade.normal(inputs.numpy()).all():
+            # confidently normal, skips the model and is never cached
+            n_skipped += inputs.shape[0]
+            probabilities = np.zeros((inputs.shape[0], 2), dtype=np.float32)
+            probabilities[:, 0] = 1.0
+            predictions[filename.item()] = probabilities
+            continue
         inputs = inputs.permute(
                 0, 1, 4, 2, 3).float().to(device)
         output = model(inputs)
-        pred = torch.topk(objective(output),
-                                      k=1, dim=1).indices.flatten()
+        probabilities = objective(output).detach().cpu().numpy()
+        predictions[filename.item()] = probabilities
+        if cache is not None:
+            cache.save(cache_keys[filename.item()], probabilities=probabilities)
+    if n_windows:
+        seconds = time.perf_counter() - start_time
+        logging.info("{} windows in {:.2f} second(s), {:.2f} windows/s, cascade skipped {:.1%}".format(
+            n_windows, seconds, n_windows / seconds, n_skipped / n_windows))
+
+    files = {index: file for file, index in labels.items()}
+    for index, probabilities in predictions.items():
+        pred = probabilities.argmax(axis=1).item()
         if pred:
             message = pd.NA
-            file = list(labels.keys())[list(labels.values()).index(filename.item())]
+            file = files[index]
             info = file.split("_",4)
             logging.debug(info)
             
@@ -50,8 +83,40 @@ def run(
             logs['log_message'].append(message)
     logging.info("done...")
     pd.DataFrame(logs).to_csv("bug_report.csv")
+
+
+def cached_predictions(
+    cache:FeatureCache,
+    test_files:list,
+)->Tuple[dict, dict]:
+    """ Content keys of every chunk and the softmax outputs already cached
+    """
+    cache_keys = {i: cache.key(f) for i, f in enumerate(test_files)}
+    predictions = {}
+    for i, key in cache_keys.items():
+        entry = cache.load(key)
+        if entry is not None:
+            predictions[i] = entry['probabilities']
+    logging.info(f"{len(predictions)}/{len(test_files)} chunks served from cache")
+    return cache_keys, predictions
     
 
+def model_namespace(
+    model_dir:str,
+    runtime:str,
+    backbone:str,
+    image_size:int,
+)->str:
+    """ Cache namespace of the weights `runtime` runs and the model settings,
+        so that predictions of another or a retrained model are never served
+    """
+    md5 = hashlib.md5("{}-{}-{}".format(runtime, backbone, image_size).encode())
+    with open(os.path.join(model_dir, ARTIFACTS.get(runtime, 'model.pth')), 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            md5.update(chunk)
+    return "demo-{}".format(md5.hexdigest()[:16])
+
+
 def read_log(filename:str)->pd.DataFrame:
     with open(filename, 'r') as f:
         lines = []
@@ -69,27 +134,12 @@ def read_log(filename:str)->pd.DataFrame:
     log['Total_seconds'] = log['Time'].iloc[-1] - log['Time'].iloc[0]
     return log
 
-def command_arg() -> ArgumentParser:
-    parser = ArgumentParser()
-    parser.add_argument('--eval_dir', type=str, default="data/new-meta-data",
-                        help='directory of flicker videos')
-    parser.add_argument('--log_dir', type=str, default="data/logs",
-                        help='directory of logcat logs')
-    parser.add_argument('--model_dir', type=str, default="cnn_transformers_model",
-                    help='directory of saved model paramters')
-    return parser.parse_args()
-
-def main()->None:
-    init_logger()
-    args = command_arg()
-    eval_dir,log_dir,model_dir = args.eval_dir,args.log_dir,args.model_dir
-    test_files = [os.path.join(eval_dir,f) for f in os.listdir(eval_dir)]
-    labels = {
-        f.split("/",3)[-1].replace(".mp4",""):i 
-        for i,f in enumerate(test_files)
-    }
-    # device =torch.device('cpu')
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+def load_model(
+    model_dir:str,
+    device:torch.device,
+    backbone:str='vgg19',
+    image_size:int=None,
+)->torch.nn.Module:
     model = CNN_Transformers(
         image_size=360,          # image size
         frames=10,               # number of frames
@@ -100,7 +150,7 @@ def main()->None:
         depth=6,
         heads=8,
         mlp_dim=512,
-        cnn=torchvision.models.vgg19(pretrained=True),
+        cnn=Backbone(backbone, image_size=image_size),
         dropout=0.1,
         emb_dropout=0.1,
         pool='cls' 
@@ -111,15 +161,138 @@ def main()->None:
     # model = model.module.to(device)
     model.to(device)
     model.eval()
+    return model
+
+
+def localize(
+    model:torch.nn.Module,
+    device:torch.device,
+    test_files:list,
+    strides:list,
+    threshold:float,
+    output_path:str="localization.csv",
+)->None:
+    """ Frame positions of the flickers in every recording, scored coarse-to-fine
+    """
+    localizer = TemporalLocalizer(model, device, strides=strides, threshold=threshold)
+    rows = {'video':[], 'frame':[], 'label_key':[]}
+    evaluations, saved = 0, 0
+    for file in tqdm.tqdm(test_files):
+        name = os.path.basename(file).replace(".mp4","")
+        result = localizer.localize(skvideo.io.vread(file))
+        evaluations += result['evaluations']
+        saved += result['saved']
+        rows['video'] += [name]*len(result['positions'])
+        rows['frame'] += result['positions']
+        rows['label_key'] += TemporalLocalizer.label_keys(result['positions'], name)
+    logging.info(f"{evaluations} windows scored, {saved} saved by strides {strides}")
+    pd.DataFrame(rows).to_csv(output_path)
+
+
+def test_localize(n_frames:int=60, flickers:range=range(28, 36))->None:
+    """ Smoke run of --localize on one short clip, written to a temporary
+        directory, with a model that fires on bright centre frames
+    """
+    import tempfile
+
+    class CentreFrame(torch.nn.Module):
+        def forward(self, x):
+            centre = x[:, x.shape[1] // 2].mean(dim=(1, 2, 3)) / 255
+            return torch.stack([1 - centre, centre], dim=1) * 10
+
+    video = np.zeros((n_frames, 64, 64, 3), dtype=np.uint8)
+    video[list(flickers)] = 255
+    clip_dir = tempfile.mkdtemp()
+    clip = os.path.join(clip_dir, "smoke.mp4")
+    skvideo.io.vwrite(clip, video)
+    output_path = os.path.join(clip_dir, "localization.csv")
+    localize(CentreFrame(), torch.device("cpu"), [clip], strides=[8, 1],
+             threshold=0.5, output_path=output_path)
+    positions = pd.read_csv(output_path)['frame'].tolist()
+    assert positions == list(flickers), positions
+    print("localized frames {}".format(positions))
+
+
+def command_arg() -> ArgumentParser:
+    parser = ArgumentParser()
+    parser.add_argument('--eval_dir', type=str, default="data/new-meta-data",
+                        help='directory of flicker videos')
+    parser.add_argument('--log_dir', type=str, default="data/logs",
+                        help='directory of logcat logs')
+    parser.add_argument('--model_dir', type=str, default="cnn_transformers_model",
+                    help='directory of saved model paramters')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                    help='directory of the prediction cache, disabled if not given')
+    parser.add_argument('--cache_max_bytes', type=int, default=1 << 30,
+                    help='size the prediction cache is evicted down to')
+    parser.add_argument('--cascade', action='store_true', default=False,
+                    help='skip windows the pixel-statistics cascade finds normal, needs --cascade_thresholds')
+    parser.add_argument('--cascade_thresholds', type=float, nargs=3, default=None,
+                    help='luminance jump, histogram distance and frame difference thresholds calibrated by python3 -m mypyfunc.cascade')
+    parser.add_argument('--localize', action='store_true', default=False,
+                    help='localize the flicker frames of full-length recordings in eval_dir instead')
+    parser.add_argument('--strides', type=int, nargs='+', default=[8, 1],
+                    help='decreasing stride schedule of the localization')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                    help='min flicker probability of a positive window')
+    parser.add_argument('--test_localize', action='store_true', default=False,
+                    help='localize flickers of a short synthetic clip and exit')
+    parser.add_argument('--backbone', type=str, default="vgg19", choices=list(BACKBONES),
+                    help='per-frame CNN the model was trained with')
+    parser.add_argument('--image_size', type=int, default=None,
+                    help='backbone resolution the model was trained with, 360 if not given')
+    parser.add_argument('--runtime', type=str, default="eager", choices=RUNTIMES,
+                    help='eager model.pth, or the model exported to model_dir by mypyfunc.export, onnx runs on the CPU')
+    args = parser.parse_args()
+    if args.cascade and args.cascade_thresholds is None:
+        # the defaults of CascadeFilter were never measured against the recall
+        parser.error("--cascade needs the --cascade_thresholds printed by python3 -m mypyfunc.cascade")
+    return args
+
+def main()->None:
+    init_logger()
+    args = command_arg()
+    if args.test_localize:
+        test_localize()
+        return
+    eval_dir,log_dir,model_dir = args.eval_dir,args.log_dir,args.model_dir
+    test_files = [os.path.join(eval_dir,f) for f in os.listdir(eval_dir)]
+    labels = {
+        f.split("/",3)[-1].replace(".mp4",""):i 
+        for i,f in enumerate(test_files)
+    }
+    # device =torch.device('cpu')
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.runtime == "onnx":
+        device = torch.device("cpu")
+    model = load_runtime(args.runtime, model_dir, device) if args.runtime != "eager" \
+        else load_model(model_dir, device, args.backbone, args.image_size)
     objective = torch.nn.Softmax()
+
+    if args.localize:
+        localize(model, device, test_files, args.strides, args.threshold)
+        return
     
-    test_ds = VideoDataSet.split_datasets(
-        test_files, labels=labels, class_size=1, max_workers=1, undersample=0)
-    stream = MultiStreamer(
-        test_ds,
-        batch_size=0,
-        binary=False
-    )
+    cache, cache_keys, predictions = None, None, {}
+    if args.cache_dir:
+        namespace = model_namespace(model_dir, args.runtime, args.backbone, args.image_size)
+        cache = FeatureCache(args.cache_dir, namespace=namespace,
+                             max_bytes=args.cache_max_bytes)
+        cache_keys, predictions = cached_predictions(cache, test_files)
+
+    stream = None
+    stream_files = [f for i, f in enumerate(test_files) if i not in predictions]
+    if stream_files:
+        test_ds = VideoDataSet.split_datasets(
+            stream_files, labels=labels, class_size=1, max_workers=1, undersample=0)
+        stream = MultiStreamer(
+            test_ds,
+            batch_size=0,
+            binary=False
+        )
+    cascade = None
+    if args.cascade:
+        cascade = CascadeFilter(*args.cascade_thresholds)
     run(
         model=model,
         stream=stream,
@@ -127,6 +300,10 @@ def main()->None:
         objective=objective,
         labels=labels,
         log_dir=log_dir,
+        cache=cache,
+        cache_keys=cache_keys,
+        predictions=predictions,
+        cascade=cascade,
     )
     
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 import os
 import json
+import time
 import cv2
 import tqdm
 import logging
@@ -17,6 +18,8 @@ from tensorflow.keras import Model
 from mypyfunc.logger import init_logger
 from typing import Tuple
 from preprocessing.embedding.backbone import BaseCNN, Serializer
+from preprocessing.deduplication.frame_hash import FrameHash
+from mypyfunc.feature_cache import FeatureCache
 from mypyfunc.keras_models import Model, InferenceModel
 from mypyfunc.keras_eval import Metrics
 from mypyfunc.torch_data_loader import Streamer
@@ -58,7 +61,8 @@ def serialize_embed(
 def np_embed(
     video_data_dir: str,
     mapping_path: str,
-    output_dir: str
+    output_dir: str,
+    cache: FeatureCache = None,
 ) -> None:
     os.makedirs(output_dir, exist_ok=True)
     mapping = {
@@ -71,18 +75,35 @@ def np_embed(
         if os.path.exists(os.path.join(output_dir, "{}.npy".format(path))):
             continue
 
-        vidcap = cv2.VideoCapture(os.path.join(video_data_dir, path))
-        success, image = vidcap.read()
+        video_path = os.path.join(video_data_dir, path)
+        cached = None
+        if cache is not None:
+            cache_key = cache.key(video_path)
+            cached = cache.load(cache_key)
 
-        embeddings = ()
-        while success:
-            embeddings += (
-                feature_extractor.get_embed_cpu(
-                    cv2.resize(image, (200, 200)), batched=False
-                ).flatten(),)
+        if cached is not None:
+            embeddings = cached["embeddings"]
+        else:
+            vidcap = cv2.VideoCapture(video_path)
             success, image = vidcap.read()
 
-        embeddings = np.array(embeddings)
+            frame_hash = FrameHash()
+            embed_seconds = 0.0
+            embeddings = ()
+            while success:
+                if not frame_hash.is_repeat(image):
+                    embed_start = time.perf_counter()
+                    embeddings += (
+                        feature_extractor.get_embed_cpu(
+                            cv2.resize(image, (200, 200)), batched=False
+                        ).flatten(),)
+                    embed_seconds += time.perf_counter() - embed_start
+                success, image = vidcap.read()
+
+            embeddings = frame_hash.expand(embeddings)
+            frame_hash.report(path, embed_seconds)
+            if cache is not None:
+                cache.save(cache_key, embeddings=embeddings)
         logging.info(f"{path} / {embeddings.shape}")
 
         real_name = path.split(".mp4")[0]  # mapping[path.split(".mp4")[0]]
@@ -208,6 +229,10 @@ def command_arg() -> ArgumentParser:
                         help='directory of miscenllaneous information')
     parser.add_argument('--videos_path', type=str, default="data/0824",
                         help='src directory to extract embeddings from')
+    parser.add_argument('--feature_cache', type=str, default=".cache/features",
+                        help='directory of the content-addressed embedding cache')
+    parser.add_argument('--cache_max_bytes', type=int, default=2 << 30,
+                        help='size the embedding cache is evicted down to')
     parser.add_argument(
         "-train", "--train", action="store_true",
         default=False,
@@ -248,6 +273,11 @@ def main():
         videos_path,
         mapping_path,
         data_path,
+        cache=FeatureCache(
+            args.feature_cache,
+            namespace="vgg16",
+            max_bytes=args.cache_max_bytes
+        ),
     )
     logging.info("[Embedding] done.")
 
@@ -16,6 +16,7 @@ from argparse import ArgumentParser
 from collections import Counter
 from typing import Tuple
 from mypyfunc.logger import init_logger
+from preprocessing.bitstream.packets import PacketScanner
 
 
 def get_pts(
@@ -30,15 +31,10 @@ def get_pts(
     for vid in os.listdir(src):
         if os.path.exists(os.path.join(dst, "{}".format(mapping[vid.split(".mp4")[0].replace(" ", "")]))):
             continue
-        fh = av.open(os.path.join(src, vid))
-        video = fh.streams.video[0]
-        decoded = tuple(fh.decode(video))
-        print(f"{vid} duration: {float(video.duration*video.time_base)}")
-        pts_interval = np.array((0,) + tuple(
-            float(decoded[i+1].pts*video.time_base -
-                  decoded[i].pts*video.time_base)
-            for i in range(0, len(decoded)-1, 1)
-        ))
+        # packets are demuxed only, the intervals match the decoded frames
+        statistics = PacketScanner.scan(os.path.join(src, vid))
+        print(f"{vid} duration: {statistics['pts'][-1] - statistics['pts'][0]}")
+        pts_interval = statistics['intervals']
         std_arr = ((pts_interval - pts_interval.mean(axis=0)) /
                    pts_interval.std(axis=0))
         np.save(os.path.join(
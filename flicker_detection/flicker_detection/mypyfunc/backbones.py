@@ -0,0 +1,186 @@
+import time
+import torch
+import torchvision
+import torch.nn as nn
+import torch.nn.functional as F
+
+from argparse import ArgumentParser
+from typing import Callable, Dict, Tuple
+
+from mypyfunc.torch_utility import peak_memory
+
+
+def resnet_features(cnn: nn.Module) -> Tuple[nn.Module, nn.Module]:
+    """ ResNets have no `features`, everything before the pooling is """
+    return nn.Sequential(
+        cnn.conv1, cnn.bn1, cnn.relu, cnn.maxpool,
+        cnn.layer1, cnn.layer2, cnn.layer3, cnn.layer4,
+    ), cnn.avgpool
+
+
+def torchvision_features(cnn: nn.Module) -> Tuple[nn.Module, nn.Module]:
+    return cnn.features, cnn.avgpool
+
+
+# name: (torchvision constructor, split into `features` and `avgpool`)
+BACKBONES: Dict[str, Tuple[Callable[..., nn.Module], Callable]] = {
+    "vgg16": (torchvision.models.vgg16, torchvision_features),
+    "vgg19": (torchvision.models.vgg19, torchvision_features),
+    "resnet18": (torchvision.models.resnet18, resnet_features),
+    "resnet34": (torchvision.models.resnet34, resnet_features),
+    "mobilenet_v3_small": (torchvision.models.mobilenet_v3_small, torchvision_features),
+    "mobilenet_v3_large": (torchvision.models.mobilenet_v3_large, torchvision_features),
+    "efficientnet_b0": (torchvision.models.efficientnet_b0, torchvision_features),
+}
+
+
+class Resize(nn.Module):
+    """Bilinear resize of (N, C, H, W) frames to `size`, a no-op at that size
+    """
+
+    def __init__(self, size: int) -> None:
+        super().__init__()
+        self.size = (size, size)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if tuple(x.shape[-2:]) == self.size:
+            return x
+        return F.interpolate(x, size=self.size, mode="bilinear", align_corners=False)
+
+    def extra_repr(self) -> str:
+        return "size={}".format(self.size)
+
+
+class Backbone(nn.Module):
+    """Per-frame CNN with the `features` and `avgpool` of a torchvision VGG
+
+    CNN_LSTM and CNN_Transformers take both from the `cnn` they are given, so
+    any registered backbone can replace the VGG19. `features` is flat, for
+    checkpoint_sequential, and with `image_size` it starts with a Resize so
+    that the 360x360 chunks are fed at that resolution. Every pooling is
+    adaptive, see `feature_dim` for the resulting #features.
+
+    Args:
+        name (:obj:`str`): One of BACKBONES.
+        image_size (:obj:`int`, optional): Input resolution of the backbone.
+            Defaults to None, the resolution of the frames.
+        pretrained (:obj:`bool`, optional): Load the ImageNet weights.
+            Defaults to True.
+
+    """
+
+    def __init__(self, name: str, image_size: int = None, pretrained: bool = True) -> None:
+        super().__init__()
+        assert name in BACKBONES, "backbone should be one of {}".format(sorted(BACKBONES))
+        build, split = BACKBONES[name]
+        features, self.avgpool = split(build(weights="DEFAULT" if pretrained else None))
+        layers = ([Resize(image_size)] if image_size else []) + list(features)
+        self.features = nn.Sequential(*layers)
+        self.name = name
+        self.image_size = image_size
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.avgpool(self.features(x)).flatten(start_dim=1)
+
+
+@torch.no_grad()
+def feature_dim(cnn: nn.Module, image_size: int = 360) -> int:
+    """ #features per frame of `cnn.features` + `cnn.avgpool`, from one
+        frame of image_size x image_size
+    """
+    was_training = cnn.training
+    cnn.eval()
+    parameter = next(cnn.parameters())
+    frame = torch.zeros((1, 3, image_size, image_size),
+                        dtype=parameter.dtype, device=parameter.device)
+    dim = cnn.avgpool(cnn.features(frame)).flatten(start_dim=1).shape[-1]
+    cnn.train(was_training)
+    return dim
+
+
+def count_flops(model: nn.Module, inputs: torch.Tensor) -> int:
+    """ FLOPs of the convolutions and linear layers in one forward pass,
+        a multiply-add counts as two, the rest is negligible for these CNNs
+    """
+    flops = 0
+
+    def conv(module, _, output):
+        nonlocal flops
+        kernel = module.in_channels // module.groups * \
+            module.kernel_size[0] * module.kernel_size[1]
+        flops += 2 * output.numel() * kernel
+
+    def linear(module, _, output):
+        nonlocal flops
+        flops += 2 * output.numel() * module.in_features
+
+    handles = [
+        m.register_forward_hook(conv if isinstance(m, nn.Conv2d) else linear)
+        for m in model.modules() if isinstance(m, (nn.Conv2d, nn.Linear))
+    ]
+    try:
+        model(inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return flops
+
+
+@torch.no_grad()
+def measure(name: str, image_size: int, frames: int, repeats: int) -> dict:
+    """ Params, FLOPs, CPU latency and peak memory of one backbone on a chunk
+        of `frames` frames, the memory is the growth of the peak resident
+        size so each backbone should run in a fresh process
+    """
+    baseline = peak_memory("cpu")
+    model = Backbone(name, pretrained=False).eval()
+    inputs = torch.rand((frames, 3, image_size, image_size))
+    # also the warm-up
+    flops = count_flops(model, inputs)
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        model(inputs)
+    latency = (time.perf_counter() - start_time) / repeats
+    return dict({
+        "name": name,
+        "features": feature_dim(model, image_size),
+        "params": sum(p.numel() for p in model.parameters()),
+        "flops": flops,
+        "latency": latency,
+        "memory": peak_memory("cpu") - baseline,
+    })
+
+
+def benchmark(names: list, image_size: int, frames: int, repeats: int) -> None:
+    """ One spawned process per backbone, the resident size never shrinks """
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    print("{:>20} {:>9} {:>10} {:>12} {:>12} {:>10}".format(
+        "backbone", "features", "params(M)", "GFLOPs/chunk", "ms/chunk", "peak(MB)"))
+    for name in names:
+        with context.Pool(1) as pool:
+            result = pool.apply(measure, (name, image_size, frames, repeats))
+        print("{:>20} {:>9} {:>10.2f} {:>12.2f} {:>12.1f} {:>10.1f}".format(
+            result["name"], result["features"], result["params"] / 1e6,
+            result["flops"] / 1e9, result["latency"] * 1e3, result["memory"]))
+
+
+def command_arg() -> ArgumentParser:
+    parser = ArgumentParser()
+    parser.add_argument('--backbones', type=str, nargs='+', default=list(BACKBONES),
+                        choices=list(BACKBONES), help='backbones to benchmark')
+    parser.add_argument('--image_size', type=int, default=360,
+                        help='frame resolution fed to the backbones')
+    parser.add_argument('--frames', type=int, default=10,
+                        help='#frames per chunk')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='#timed forward passes per backbone')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """
+    python3 -m mypyfunc.backbones --image_size 224
+    """
+    args = command_arg()
+    benchmark(args.backbones, args.image_size, args.frames, args.repeats)
@@ -0,0 +1,185 @@
+import os
+import time
+import logging
+import numpy as np
+
+from argparse import ArgumentParser
+from typing import Tuple
+
+
+class CascadeFilter:
+    """Cheap pixel-statistics stage that skips windows before the CNN
+
+    Every window is reduced to three statistics of its downsampled luminance
+    between consecutive frames: the largest mean-luminance jump, the largest
+    histogram distance and the largest mean absolute frame difference, the
+    latter at the best vertical shift so that scrolling does not count. A
+    window is confidently normal when all of them are below their thresholds,
+    an np.inf threshold disables that statistic. The default thresholds are
+    not calibrated, `calibrate` them on labelled windows before gating the
+    model, see `main`.
+
+    Args:
+        luminance_threshold (:obj:`float`, optional): Luminance jump in 0-255
+            gray levels. Defaults to 8.0.
+        histogram_threshold (:obj:`float`, optional): Total variation distance
+            between normalized histograms, in [0, 1]. Defaults to 0.15.
+        difference_threshold (:obj:`float`, optional): Mean absolute frame
+            difference in 0-255 gray levels. Defaults to 12.0.
+        stride (:obj:`int`, optional): Downsampling step along both axes.
+            Defaults to 8.
+        bins (:obj:`int`, optional): #luminance histogram bins. Defaults to 32.
+        max_shift (:obj:`int`, optional): Largest vertical scroll compensated
+            between two frames, in downsampled rows. Defaults to 8.
+
+    """
+
+    names = ("luminance_jump", "histogram_distance", "frame_difference")
+
+    def __init__(
+        self,
+        luminance_threshold: float = 8.0,
+        histogram_threshold: float = 0.15,
+        difference_threshold: float = 12.0,
+        stride: int = 8,
+        bins: int = 32,
+        max_shift: int = 8,
+    ) -> None:
+        self.thresholds = np.array(
+            [luminance_threshold, histogram_threshold, difference_threshold])
+        self.__stride = stride
+        self.__bins = bins
+        self.__max_shift = max_shift
+        self.__luma = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+    def statistics(self, windows: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            windows (:obj:`np.ndarray`): RGB windows of shape
+                (#windows, #frames, height, width, 3).
+
+        Returns:
+            np.ndarray: (#windows, 3) statistics in the order of `names`
+
+        """
+        windows = np.asarray(windows)
+        small = windows[:, :, ::self.__stride, ::self.__stride]
+        luma = small.astype(np.float32) @ self.__luma
+        n_windows, n_frames, height = luma.shape[:3]
+
+        frame_difference = np.min([
+            np.abs(
+                luma[:, 1:, max(shift, 0):height + min(shift, 0)] -
+                luma[:, :-1, max(-shift, 0):height + min(-shift, 0)]
+            ).mean(axis=(2, 3))
+            for shift in range(-self.__max_shift, self.__max_shift + 1)
+            if abs(shift) < height
+        ], axis=0).max(axis=1)
+
+        luma = luma.reshape(n_windows, n_frames, -1)
+        luminance_jump = np.abs(np.diff(luma.mean(axis=-1), axis=1)).max(axis=1)
+
+        # one bincount over every frame, offsetting each frame into its own bins
+        levels = np.clip(luma * (self.__bins / 256.0),
+                         0, self.__bins - 1).astype(np.int64)
+        offsets = np.arange(n_windows * n_frames).reshape(
+            n_windows, n_frames, 1) * self.__bins
+        histograms = np.bincount(
+            (levels + offsets).ravel(), minlength=n_windows * n_frames * self.__bins
+        ).reshape(n_windows, n_frames, self.__bins) / luma.shape[-1]
+        histogram_distance = 0.5 * \
+            np.abs(np.diff(histograms, axis=1)).sum(axis=-1).max(axis=1)
+
+        return np.stack([luminance_jump, histogram_distance, frame_difference], axis=1)
+
+    def normal(self, windows: np.ndarray) -> np.ndarray:
+        """ (#windows,) flags of the windows that can skip the model
+        """
+        return np.all(self.statistics(windows) < self.thresholds, axis=1)
+
+    def calibrate(self, statistics: np.ndarray, labels: np.ndarray, recall: float = 0.99) -> np.ndarray:
+        """ Set every threshold to the (1 - recall) quantile of the flicker
+            windows, a flicker window is kept when any statistic reaches its
+            threshold so at least `recall` of them are kept
+        """
+        positives = statistics[np.asarray(labels) > 0]
+        if len(positives):
+            self.thresholds = np.quantile(positives, 1 - recall, axis=0)
+        logging.info("Cascade thresholds: {}".format(
+            dict(zip(self.names, self.thresholds.tolist()))))
+        return self.thresholds
+
+
+def evaluate(
+    cascade: CascadeFilter,
+    statistics: np.ndarray,
+    labels: np.ndarray
+) -> Tuple[float, float]:
+    """ (skip rate, recall retained) of the cascade on labelled windows
+    """
+    labels = np.asarray(labels) > 0
+    skipped = np.all(statistics < cascade.thresholds, axis=1)
+    recall = 1 - skipped[labels].mean() if labels.any() else float("nan")
+    return skipped.mean(), recall
+
+
+def command_arg() -> ArgumentParser:
+    parser = ArgumentParser()
+    parser.add_argument('--flicker_dirs', type=str, nargs='+',
+                        default=["data/flicker1", "data/flicker2",
+                                 "data/flicker3", "data/flicker4"],
+                        help='directories of flicker video chunks')
+    parser.add_argument('--non_flicker_dir', type=str, default="data/no_flicker",
+                        help='directory of processed non flicker video chunks')
+    parser.add_argument('--cache_path', type=str, default=".cache/train_test",
+                        help='directory of miscenllaneous information')
+    parser.add_argument('--recall', type=float, default=0.99,
+                        help='flicker recall the calibrated thresholds keep on the train split')
+    return parser.parse_args()
+
+
+def main() -> None:
+    """ Calibrate the thresholds on the train split and report the skip rate
+        and recall retained on the test split
+    """
+    import skvideo.io
+    from mypyfunc.logger import init_logger
+
+    init_logger()
+    args = command_arg()
+    __cache__ = np.load("{}.npz".format(args.cache_path), allow_pickle=True)
+    flicker_train, non_flicker_train, flicker_test, non_flicker_test = tuple(
+        __cache__[lst] for lst in __cache__)
+
+    cascade = CascadeFilter()
+
+    def split_statistics(flicker: list, non_flicker: list) -> Tuple[np.ndarray, np.ndarray]:
+        paths = [(os.path.join(args.non_flicker_dir, f), 0) for f in non_flicker]
+        for f in flicker:
+            paths += [(os.path.join(d, f), 1) for d in args.flicker_dirs
+                      if os.path.exists(os.path.join(d, f))]
+        start = time.perf_counter()
+        statistics = np.concatenate([
+            cascade.statistics(skvideo.io.vread(path)[None]) for path, _ in paths
+        ])
+        logging.info("{} windows in {:.2f} second(s)".format(
+            len(paths), time.perf_counter() - start))
+        return statistics, np.array([label for _, label in paths])
+
+    cascade.calibrate(
+        *split_statistics(flicker_train, non_flicker_train),
+        recall=args.recall
+    )
+    skip_rate, recall = evaluate(
+        cascade, *split_statistics(flicker_test, non_flicker_test))
+    print("thresholds: {}".format(
+        " ".join("{:.4f}".format(t) for t in cascade.thresholds)))
+    print("test split: skip rate {:.1%}, recall retained {:.1%}".format(
+        skip_rate, recall))
+
+
+if __name__ == "__main__":
+    """
+    python3 -m mypyfunc.cascade
+    """
+    main()
@@ -0,0 +1,259 @@
+import os
+import time
+import inspect
+import logging
+import torch
+
+from argparse import ArgumentParser
+from typing import Dict
+
+from mypyfunc.backbones import BACKBONES, Backbone, feature_dim
+from mypyfunc.torch_models import CNN_LSTM, CNN_Transformers
+
+
+RUNTIMES = ("eager", "torchscript", "onnx")
+ARTIFACTS = {"torchscript": "model.torchscript.pt", "onnx": "model.onnx"}
+
+
+def build_model(
+    name: str,
+    backbone: str = "vgg19",
+    image_size: int = None,
+    pretrained: bool = True,
+) -> torch.nn.Module:
+    """ The CNN_LSTM of training.py or the CNN_Transformers of demo.py """
+    cnn = Backbone(backbone, image_size=image_size, pretrained=pretrained)
+    if name == "cnn_lstm":
+        return CNN_LSTM(
+            cnn=cnn,
+            input_dim=feature_dim(cnn, image_size or 360),
+            output_dim=2,
+            hidden_dim=64,
+            layer_dim=1,
+            bidirectional=True,
+        )
+    assert name == "cnn_transformers", "model should be cnn_lstm or cnn_transformers"
+    return CNN_Transformers(
+        image_size=360,          # image size
+        frames=10,               # number of frames
+        image_patch_size=36,     # image patch size
+        frame_patch_size=10,      # frame patch size
+        num_classes=2,
+        dim=512,
+        depth=6,
+        heads=8,
+        mlp_dim=512,
+        cnn=cnn,
+        dropout=0.1,
+        emb_dropout=0.1,
+        pool='cls'
+    )
+
+
+def load_weights(model: torch.nn.Module, load_path: str, device: torch.device) -> torch.nn.Module:
+    """ Load a model.pth of training.py, saved from DataParallel or DDP, into
+        the unwrapped model
+    """
+    state_dict = torch.load(load_path, map_location=device)['model_state_dict']
+    model.load_state_dict({
+        key[len("module."):] if key.startswith("module.") else key: value
+        for key, value in state_dict.items()
+    })
+    return model.to(device).eval()
+
+
+class OnnxModel:
+    """ONNX Runtime session called like the eager model
+
+    Takes and returns torch tensors so that demo.py and TemporalLocalizer
+    run it unchanged, the inputs are moved to the CPU.
+
+    Args:
+        onnx_path (:obj:`str`): Path of the exported model.onnx.
+        threads (:obj:`int`, optional): Intra-op threads, 0 lets ONNX
+            Runtime decide. Defaults to 0.
+
+    """
+
+    def __init__(self, onnx_path: str, threads: int = 0) -> None:
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        logits, = self.session.run(
+            None, {self.input_name: x.detach().cpu().float().numpy()})
+        return torch.from_numpy(logits)
+
+    def eval(self) -> "OnnxModel":
+        return self
+
+
+@torch.no_grad()
+def export(
+    model: torch.nn.Module,
+    output_dir: str,
+    frames: int = 10,
+    image_size: int = 360,
+    opset: int = 14,
+) -> Dict[str, str]:
+    """ Trace the eval model into a TorchScript file and an ONNX graph, both
+        with a dynamic batch dimension
+
+    Args:
+        model (:obj:`torch.nn.Module`): Unwrapped CNN_LSTM or CNN_Transformers.
+        output_dir (:obj:`str`): Directory of the artifacts.
+        frames (:obj:`int`, optional): #frames per chunk. Defaults to 10.
+        image_size (:obj:`int`, optional): Height and width of the frames.
+            Defaults to 360.
+        opset (:obj:`int`, optional): ONNX opset. Defaults to 14.
+
+    Returns:
+        dict: Path of every artifact by runtime
+
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.cpu().eval()
+    # batch of 2 so that no size is traced as a constant 1
+    example = torch.rand((2, frames, 3, image_size, image_size))
+    paths = {runtime: os.path.join(output_dir, artifact)
+             for runtime, artifact in ARTIFACTS.items()}
+
+    torch.jit.save(torch.jit.trace(model, example, check_trace=False),
+                   paths["torchscript"])
+
+    # the TorchScript-based exporter, the default one before torch 2.9
+    legacy = {"dynamo": False} if "dynamo" in inspect.signature(
+        torch.onnx.export).parameters else {}
+    torch.onnx.export(
+        model, example, paths["onnx"],
+        input_names=["frames"], output_names=["logits"],
+        dynamic_axes={"frames": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=opset, **legacy)
+    logging.info("Exported {}".format(", ".join(paths.values())))
+    return paths
+
+
+def load_runtime(
+    runtime: str,
+    model_dir: str,
+    device: torch.device,
+    model: torch.nn.Module = None,
+) -> object:
+    """ The exported model of `runtime` in model_dir, or `model` for eager """
+    if runtime == "eager":
+        return model
+    assert runtime in ARTIFACTS, "runtime should be one of {}".format(RUNTIMES)
+    path = os.path.join(model_dir, ARTIFACTS[runtime])
+    if runtime == "onnx":
+        return OnnxModel(path)
+    return torch.jit.load(path, map_location=device).eval()
+
+
+@torch.no_grad()
+def compare(
+    model: torch.nn.Module,
+    paths: Dict[str, str],
+    batch_sizes: tuple = (1, 3),
+    frames: int = 10,
+    image_size: int = 360,
+    repeats: int = 5,
+) -> Dict[str, dict]:
+    """ Max |logits| difference against the eager model, over several batch
+        sizes to exercise the dynamic axis, and CPU seconds per window
+    """
+    model = model.cpu().eval()
+    runtimes = {
+        "eager": model,
+        "torchscript": torch.jit.load(paths["torchscript"], map_location="cpu"),
+        "onnx": OnnxModel(paths["onnx"]),
+    }
+    results = {runtime: {"difference": 0.0} for runtime in runtimes}
+    for batch_size in batch_sizes:
+        inputs = torch.rand((batch_size, frames, 3, image_size, image_size)) * 255
+        expected = model(inputs)
+        for runtime, executor in runtimes.items():
+            difference = (executor(inputs) - expected).abs().max().item()
+            results[runtime]["difference"] = max(results[runtime]["difference"], difference)
+
+    inputs = torch.rand((max(batch_sizes), frames, 3, image_size, image_size)) * 255
+    for runtime, executor in runtimes.items():
+        executor(inputs)
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            executor(inputs)
+        results[runtime]["latency"] = (time.perf_counter() - start_time) / \
+            (repeats * len(inputs))
+    return results
+
+
+def report(results: Dict[str, dict]) -> None:
+    print("{:>12} {:>14} {:>12} {:>9}".format(
+        "runtime", "max |logits|", "ms/window", "speed-up"))
+    for runtime, result in results.items():
+        print("{:>12} {:>14.2e} {:>12.2f} {:>8.2f}x".format(
+            runtime, result["difference"], result["latency"] * 1e3,
+            results["eager"]["latency"] / result["latency"]))
+
+
+def test_export(atol: float = 1e-4) -> None:
+    """ Both small models agree with eager after export, on batch sizes
+        other than the traced one
+    """
+    import tempfile
+    torch.manual_seed(0)
+    for name in ("cnn_lstm", "cnn_transformers"):
+        model = build_model(name, backbone="mobilenet_v3_small",
+                            image_size=96, pretrained=False)
+        paths = export(model, tempfile.mkdtemp())
+        results = compare(model, paths, repeats=2)
+        for runtime, result in results.items():
+            # logits are O(1) at initialization
+            assert result["difference"] < atol, (name, runtime, result)
+        print(name)
+        report(results)
+
+
+def command_arg() -> ArgumentParser:
+    parser = ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default="cnn_transformers_model",
+                        help='directory of the model.pth to export')
+    parser.add_argument('--output_dir', type=str, default=None,
+                        help='directory of the exported models, model_dir if not given')
+    parser.add_argument('--model', type=str, default="cnn_transformers",
+                        choices=["cnn_lstm", "cnn_transformers"],
+                        help='architecture of model.pth')
+    parser.add_argument('--backbone', type=str, default="vgg19", choices=list(BACKBONES),
+                        help='per-frame CNN the model was trained with')
+    parser.add_argument('--image_size', type=int, default=None,
+                        help='backbone resolution the model was trained with, 360 if not given')
+    parser.add_argument('--test', action='store_true', default=False,
+                        help='export small random models, check their parity and exit')
+    return parser.parse_args()
+
+
+def main() -> None:
+    """ Export model.pth, then compare the exported models with eager """
+    from mypyfunc.logger import init_logger
+
+    init_logger()
+    args = command_arg()
+    if args.test:
+        test_export()
+        return
+    model = build_model(args.model, args.backbone, args.image_size, pretrained=False)
+    model = load_weights(model, os.path.join(args.model_dir, 'model.pth'),
+                         torch.device("cpu"))
+    paths = export(model, args.output_dir or args.model_dir)
+    report(compare(model, paths, batch_sizes=(1, 2), repeats=3))
+
+
+if __name__ == "__main__":
+    """
+    python3 -m mypyfunc.export --model_dir cnn_transformers_model
+    """
+    main()
@@ -0,0 +1,139 @@
+import os
+import json
+import glob
+import hashlib
+import logging
+import tempfile
+import numpy as np
+
+from typing import Callable, Dict, Optional
+
+
+class FeatureCache:
+    """Content-addressed, size-bounded cache of numpy feature arrays
+
+    Entries are keyed by a streaming md5 of the source file. A cheap pre-key
+    of (size, mtime, md5 of head and tail) is mapped to that digest in an
+    on-disk index, so an unchanged file is never read in full twice. Index
+    entries whose digest has no ``.npz`` left are pruned on eviction.
+
+    Args:
+        cache_dir (:obj:`str`): Directory that stores the ``.npz`` entries.
+        namespace (:obj:`str`, optional): Prefix that separates entries of
+            different feature types computed from the same file.
+        max_bytes (:obj:`int`, optional): Total size of all entries in
+            ``cache_dir``, least recently used entries are evicted beyond
+            it. Defaults to 2 GiB.
+        chunk_size (:obj:`int`, optional): Read size of the streaming digest,
+            also the size of the head and tail in the pre-key.
+
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        namespace: str = "features",
+        max_bytes: int = 2 << 30,
+        chunk_size: int = 1 << 20,
+    ) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.__chunk_size = chunk_size
+        self.__index_path = os.path.join(cache_dir, "index.json")
+        self.__index = json.load(open(self.__index_path, "r")) \
+            if os.path.exists(self.__index_path) else {}
+        # pre-keys of this run, kept in the index until their entry is saved
+        self.__used = set()
+
+    def file_digest(self, path: str) -> str:
+        md5 = hashlib.md5()
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(self.__chunk_size), b""):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    def __pre_key(self, path: str) -> str:
+        stat = os.stat(path)
+        md5 = hashlib.md5()
+        with open(path, "rb") as fh:
+            md5.update(fh.read(self.__chunk_size))
+            if stat.st_size > self.__chunk_size:
+                fh.seek(max(stat.st_size - self.__chunk_size,
+                            self.__chunk_size))
+                md5.update(fh.read(self.__chunk_size))
+        return "{}-{}-{}".format(stat.st_size, stat.st_mtime_ns, md5.hexdigest())
+
+    def key(self, path: str) -> str:
+        pre_key = self.__pre_key(path)
+        self.__used.add(pre_key)
+        if pre_key not in self.__index:
+            self.__index[pre_key] = self.file_digest(path)
+            self.__write_index()
+        return self.__index[pre_key]
+
+    def __write_index(self) -> None:
+        self.__atomic_write(
+            self.__index_path,
+            lambda fh: fh.write(json.dumps(self.__index).encode())
+        )
+
+    def __entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, "{}-{}.npz".format(self.namespace, key))
+
+    def load(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        path = self.__entry_path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as entry:
+            arrays = {name: entry[name] for name in entry.files}
+        # mtime doubles as the last access time for LRU eviction
+        os.utime(path)
+        logging.info("Cache exists, using cache: {}".format(path))
+        return arrays
+
+    def save(self, key: str, **arrays: np.ndarray) -> str:
+        path = self.__entry_path(key)
+        self.__atomic_write(path, lambda fh: np.savez(fh, **arrays))
+        logging.debug("Cache save at: {} with size = {} bytes".format(
+            path, os.path.getsize(path)))
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: str = None) -> None:
+        entries = sorted(
+            (os.path.getmtime(path), os.path.getsize(path), path)
+            for path in glob.glob(os.path.join(self.cache_dir, "*.npz"))
+        )
+        total = sum(size for _, size, _ in entries)
+        remaining = []
+        for _, size, path in entries:
+            if total <= self.max_bytes or path == keep:
+                remaining.append(path)
+                continue
+            os.remove(path)
+            total -= size
+            logging.debug("Cache evicted: {}".format(path))
+
+        # "{namespace}-{digest}.npz", the namespace may contain dashes
+        digests = {os.path.basename(path)[:-len(".npz")].rsplit("-", 1)[-1]
+                   for path in remaining}
+        stale = [pre_key for pre_key, digest in self.__index.items()
+                 if digest not in digests and pre_key not in self.__used]
+        for pre_key in stale:
+            del self.__index[pre_key]
+        if stale:
+            self.__write_index()
+
+    def __atomic_write(self, path: str, write_fn: Callable) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                write_fn(fh)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
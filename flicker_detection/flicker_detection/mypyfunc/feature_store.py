@@ -0,0 +1,225 @@
+import os
+import time
+import random
+import logging
+import tempfile
+import torch
+import numpy as np
+
+from typing import Dict, Iterator, List, Tuple
+
+from mypyfunc.torch_utility import autocast
+
+
+class FeatureStore:
+    """On-disk store of pooled per-frame backbone features
+
+    The frozen backbone, i.e. `extractor` + `avgpool` of a CNN_LSTM or
+    CNN_Transformers, runs once per video chunk and its (#frames, features)
+    output is saved as one float16 ``.npy`` file per chunk, in a directory
+    per dataset so that "data/flicker1/x.mp4" is stored as "flicker1/x.npy".
+    Files are memory-mapped on load, so an epoch only reads the features.
+
+    Args:
+        store_dir (:obj:`str`): Root directory of the feature files.
+        dtype (:obj:`np.dtype`, optional): Storage dtype. Defaults to
+            np.float16, half of the float32 size.
+
+    """
+
+    def __init__(self, store_dir: str, dtype: np.dtype = np.float16) -> None:
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.dtype = dtype
+
+    def path(self, video_path: str) -> str:
+        dataset, name = os.path.normpath(video_path).split(os.sep)[-2:]
+        return os.path.join(self.store_dir, dataset, name.replace(".mp4", ".npy"))
+
+    def __contains__(self, video_path: str) -> bool:
+        return os.path.exists(self.path(video_path))
+
+    def load(self, video_path: str) -> np.ndarray:
+        return np.load(self.path(video_path), mmap_mode="r")
+
+    def save(self, video_path: str, features: np.ndarray) -> str:
+        path = self.path(video_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                np.save(fh, np.asarray(features, dtype=self.dtype))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return path
+
+    @torch.no_grad()
+    def build(
+        self,
+        model: torch.nn.Module,
+        video_paths: List[str],
+        device: torch.device,
+        amp: bool = False,
+    ) -> int:
+        """ Extract the features of every video not stored yet
+
+        Args:
+            model (:obj:`torch.nn.Module`): Model with `extract_features`,
+                unwrapped from DataParallel.
+            video_paths (:obj:`List[str]`): Video chunks to extract.
+            device (:obj:`torch.device`): Device of the model.
+            amp (:obj:`bool`, optional): Extract under autocast. Defaults to False.
+
+        Returns:
+            int: #videos extracted
+
+        """
+        import skvideo.io
+
+        missing = sorted({path for path in video_paths if path not in self})
+        was_training = model.training
+        model.eval()
+        start_time = time.perf_counter()
+        for video_path in missing:
+            inputs = torch.from_numpy(skvideo.io.vread(video_path)[None])
+            inputs = inputs.permute(0, 1, 4, 2, 3).float().to(device)
+            with autocast(device, enabled=amp):
+                features = model.extract_features(inputs)[0]
+            self.save(video_path, features.float().cpu().numpy())
+        model.train(was_training)
+        logging.info("Extracted features of {} video(s) in {:.2f} second(s), {} already stored".format(
+            len(missing), time.perf_counter() - start_time,
+            len(set(video_paths)) - len(missing)))
+        return len(missing)
+
+
+class FeatureStreamer(object):
+    """Batches of stored features shaped like the batches of MultiStreamer
+
+    With two video lists every batch holds batch_size // 2 chunks of each,
+    labelled 0 and 1 and shuffled, the first list is undersampled and the
+    second one cycled. With one list the chunks are labelled from `labels`
+    like VideoDataSet, a missing label is 0.
+
+    Args:
+        store (:obj:`FeatureStore`): Store holding every video.
+        *args (:obj:`List[str]`): Video paths, non-flicker then flicker.
+        batch_size (:obj:`int`): #chunks per batch.
+        labels (:obj:`dict`, optional): Labels of the imbalanced mode.
+        binary (:obj:`bool`, optional): Map every flicker label to 1.
+        undersample (:obj:`int`, optional): #non-flicker chunks per epoch
+            of the balanced mode, 0 for all of them. Defaults to 0.
+
+    """
+
+    def __init__(
+        self,
+        store: FeatureStore,
+        *args: List[str],
+        batch_size: int,
+        labels: Dict[str, int] = None,
+        binary: bool = False,
+        undersample: int = 0,
+    ) -> None:
+        self.balanced = len(args) > 1
+        self.batch_size = batch_size
+        self.undersample = undersample
+        self.__store = store
+        self.__video_lists = [list(lst) for lst in args]
+        self.__labels = labels or {}
+        self.__binary = binary
+
+    def __len__(self) -> int:
+        if self.balanced:
+            n_videos = self.undersample or len(self.__video_lists[0])
+            return n_videos // (self.batch_size // 2)
+        return -(-len(self.__video_lists[0]) // self.batch_size)
+
+    def __label(self, video_path: str) -> int:
+        label = self.__labels.get(video_path.split("/", 3)[-1].replace(".mp4", "")) or 0
+        return int(bool(label)) if self.__binary else label
+
+    def __batch(self, video_paths: List[str]) -> torch.Tensor:
+        return torch.from_numpy(np.stack([
+            self.__store.load(path) for path in video_paths
+        ]).astype(np.float32))
+
+    def __balanced(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        class_size = self.batch_size // 2
+        non_flickers, flickers = self.__video_lists[:2]
+        non_flickers = random.sample(
+            non_flickers, self.undersample or len(non_flickers))
+        flickers = random.sample(flickers, len(flickers))
+        for n in range(len(self)):
+            batch = non_flickers[n * class_size:(n + 1) * class_size] + [
+                flickers[(n * class_size + i) % len(flickers)]
+                for i in range(class_size)
+            ]
+            labels = torch.zeros(len(batch))
+            labels[class_size:] = 1
+            idx = torch.randperm(len(batch))
+            yield self.__batch(batch)[idx], labels[idx].long()
+
+    def __imbalance(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        videos = random.sample(self.__video_lists[0], len(self.__video_lists[0]))
+        for i in range(0, len(videos), self.batch_size):
+            batch = videos[i:i + self.batch_size]
+            yield self.__batch(batch), torch.Tensor([
+                self.__label(path) for path in batch
+            ]).long()
+
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        return self.__balanced() if self.balanced else self.__imbalance()
+
+
+def benchmark(steps: int = 4, batch_size: int = 4, image_size: int = 96) -> None:
+    """ Time per training step of a VGG19 CNN_LSTM on video chunks against
+        the same temporal head on stored features
+    """
+    from torchvision.models.vgg import VGG, make_layers, cfgs
+    from mypyfunc.torch_models import CNN_LSTM
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = CNN_LSTM(
+        cnn=VGG(make_layers(cfgs["E"])),
+        input_dim=25088,
+        output_dim=2,
+        hidden_dim=64,
+        layer_dim=1,
+        bidirectional=True,
+    ).to(device)
+    criterion = torch.nn.CrossEntropyLoss()
+    videos = torch.rand((batch_size, 10, 3, image_size, image_size), device=device)
+    labels = torch.arange(batch_size, device=device) % 2
+    with torch.no_grad():
+        features = model.extract_features(videos).half().float()
+
+    def seconds_per_step(inputs: torch.Tensor) -> float:
+        optimizer = torch.optim.SGD(
+            [p for p in model.parameters() if p.requires_grad], lr=1e-3)
+        start_time = time.perf_counter()
+        for _ in range(steps):
+            loss = criterion(model(inputs), labels)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        return (time.perf_counter() - start_time) / steps
+
+    end_to_end = seconds_per_step(videos)
+    model.extractor.requires_grad_(False)
+    frozen = seconds_per_step(features)
+    print("{:>12} {:>10.4f} s/step".format("end-to-end", end_to_end))
+    print("{:>12} {:>10.4f} s/step".format("features", frozen))
+    print("speed-up: {:.0f}x, {:.0f} KiB per stored chunk".format(
+        end_to_end / frozen, features[0].numel() * 2 / 1024))
+
+
+if __name__ == "__main__":
+    """
+    python3 -m mypyfunc.feature_store
+    """
+    benchmark()
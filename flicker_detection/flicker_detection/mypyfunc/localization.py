@@ -0,0 +1,162 @@
+import time
+import logging
+import torch
+import numpy as np
+
+from typing import Dict, List, Sequence
+
+
+class TemporalLocalizer:
+    """Coarse-to-fine flicker localization over a full-length recording
+
+    A window of `window` frames is centred on every scored frame, padded
+    with zeros at both ends like the overlapping training chunks. The first
+    stride of the schedule scores the whole recording, every later stride
+    only re-scores the neighbourhoods of the windows that were positive on
+    the previous level, so a stride of 1 at the end gives frame positions.
+
+    Args:
+        model (:obj:`torch.nn.Module`): A CNN_LSTM or CNN_Transformers
+            checkpoint taking (batch, frames, channels, height, width).
+        device (:obj:`torch.device`): Device of the model.
+        window (:obj:`int`, optional): #frames per window. Defaults to 10.
+        strides (:obj:`Sequence[int]`, optional): Decreasing stride schedule.
+            Defaults to (8, 1).
+        threshold (:obj:`float`, optional): Min flicker probability, i.e.
+            1 - P(class 0), of a positive window. Defaults to 0.5.
+        coarse_threshold (:obj:`float`, optional): `threshold` of every level
+            but the last, lower it to trade evaluations for recall.
+            Defaults to `threshold`.
+        batch_size (:obj:`int`, optional): #windows per model call.
+            Defaults to 8.
+
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        device: torch.device,
+        window: int = 10,
+        strides: Sequence[int] = (8, 1),
+        threshold: float = 0.5,
+        coarse_threshold: float = None,
+        batch_size: int = 8,
+    ) -> None:
+        assert list(strides) == sorted(strides, reverse=True) and strides[-1] >= 1, \
+            "strides should be a decreasing schedule of positive integers"
+        self.model = model
+        self.device = device
+        self.window = window
+        self.strides = tuple(strides)
+        self.threshold = threshold
+        self.coarse_threshold = threshold if coarse_threshold is None else coarse_threshold
+        self.batch_size = batch_size
+
+    def __windows(self, video: np.ndarray, centres: List[int]) -> torch.Tensor:
+        pad = np.zeros((len(video) + self.window, *video.shape[1:]),
+                       dtype=video.dtype)
+        pad[self.window // 2:self.window // 2 + len(video)] = video
+        return torch.from_numpy(np.stack([
+            pad[centre:centre + self.window] for centre in centres
+        ]))
+
+    @torch.no_grad()
+    def score(self, video: np.ndarray, centres: List[int]) -> np.ndarray:
+        """ Flicker probability of the windows centred on `centres`
+        """
+        scores = []
+        for i in range(0, len(centres), self.batch_size):
+            inputs = self.__windows(video, centres[i:i + self.batch_size])
+            inputs = inputs.permute(0, 1, 4, 2, 3).float().to(self.device)
+            probabilities = torch.softmax(self.model(inputs), dim=1)
+            scores.append(1 - probabilities[:, 0].cpu().numpy())
+        return np.concatenate(scores) if scores else np.zeros(0)
+
+    def localize(self, video: np.ndarray) -> Dict[str, object]:
+        """
+        Args:
+            video (:obj:`np.ndarray`): Frames of shape (#frames, height, width, 3).
+
+        Returns:
+            dict: "positions", 0-indexed flicker frames; "scores", flicker
+            probability of every scored frame; "evaluations", #windows
+            scored; "saved", #windows a dense pass at the last stride would
+            have scored on top of that
+
+        """
+        start_time = time.perf_counter()
+        n_frames = len(video)
+        scores = {}
+
+        candidates = range(0, n_frames, self.strides[0])
+        previous = self.strides[0]
+        for level, stride in enumerate(self.strides):
+            if level:
+                # every frame between the positive window and its neighbours
+                candidates = sorted({
+                    centre
+                    for positive in positives
+                    for centre in range(positive - previous + stride, positive + previous, stride)
+                    if 0 <= centre < n_frames
+                })
+            new = [centre for centre in candidates if centre not in scores]
+            scores.update(zip(new, self.score(video, new)))
+            threshold = self.threshold if level == len(self.strides) - 1 \
+                else self.coarse_threshold
+            positives = [centre for centre in candidates
+                         if scores[centre] >= threshold]
+            logging.debug("stride {}: {} windows scored, {} positive".format(
+                stride, len(new), len(positives)))
+            previous = stride
+
+        evaluations = len(scores)
+        dense = len(range(0, n_frames, self.strides[-1]))
+        logging.info("Localized {} frame(s) in {:.2f} second(s), {} of {} windows scored, {} saved".format(
+            len(positives), time.perf_counter() - start_time,
+            evaluations, dense, max(dense - evaluations, 0)))
+        return dict({
+            "positions": positives,
+            "scores": dict(sorted(scores.items())),
+            "evaluations": evaluations,
+            "saved": max(dense - evaluations, 0),
+        })
+
+    @staticmethod
+    def label_keys(positions: List[int], video_name: str) -> List[str]:
+        """ Positions in the "{frame}_{video}" format of multi_label.json,
+            whose frames are 1-indexed
+        """
+        return ["{}_{}".format(position + 1, video_name) for position in positions]
+
+
+def test_localize(n_frames: int = 500, flickers: tuple = (37, 38, 201, 450)) -> None:
+    """ The coarse-to-fine schedule finds the same frames as a dense pass on
+        a model that fires when the centre frame is a flicker frame
+    """
+    class CentreFrame(torch.nn.Module):
+        def forward(self, x):
+            centre = x[:, x.shape[1] // 2].mean(dim=(1, 2, 3))
+            return torch.stack([1 - centre, centre], dim=1) * 10
+
+    video = np.zeros((n_frames, 8, 8, 3), dtype=np.float32)
+    video[list(flickers)] = 1.0
+    # frames next to a flicker frame are partially on so that the coarse
+    # windows see them, like the smeared response of a trained model
+    for flicker in flickers:
+        video[max(flicker - 7, 0):flicker + 8] = np.maximum(
+            video[max(flicker - 7, 0):flicker + 8], 0.6)
+
+    dense = TemporalLocalizer(CentreFrame(), torch.device("cpu"), strides=(1,),
+                              threshold=0.99).localize(video)
+    coarse = TemporalLocalizer(CentreFrame(), torch.device("cpu"), strides=(8, 1),
+                               threshold=0.99, coarse_threshold=0.5).localize(video)
+    assert dense["positions"] == coarse["positions"] == list(flickers), coarse["positions"]
+    print("dense {} evaluations, coarse-to-fine {} ({} saved)".format(
+        dense["evaluations"], coarse["evaluations"], coarse["saved"]))
+
+
+if __name__ == "__main__":
+    """
+    python3 -m mypyfunc.localization
+    """
+    test_localize()
@@ -72,7 +72,15 @@ class VideoDataSet(IterableDataset):
         max_workers: int,
         oversample: bool = False,
         undersample: int = 0,
+        rank: int = 0,
+        world_size: int = 1,
     ) -> list:
+        """ Each of `world_size` ranks takes every world_size-th video from
+            `rank` on, so no two ranks share a video, and an equal part of
+            the undersampled videos
+        """
+        vid_lst = list(vid_lst)[rank::world_size]
+        undersample = max(undersample // world_size, 1) if undersample else 0
         for n in range(max_workers, 0, -1):
             if class_size % n == 0:
                 num_workers = n
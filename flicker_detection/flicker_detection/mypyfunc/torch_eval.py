@@ -10,6 +10,7 @@ import seaborn as sns
 from io import StringIO
 from typing import Tuple
 from sklearn.metrics import confusion_matrix, precision_recall_curve, roc_curve, auc, roc_auc_score, f1_score, classification_report
+from sklearn.metrics import precision_score, recall_score
 from torch.nn import functional as F
 from torch import nn
 
@@ -101,7 +102,9 @@ class F1Score:
             return self.calc_f1_micro(predictions, labels)
 
         f1_score = 0
-        for label_id in range(len(labels.unique())):
+        # classes in the labels or the predictions, like sklearn
+        label_ids = torch.cat([labels, predictions]).unique()
+        for label_id in label_ids:
             f1, true_count = self.calc_f1_count_for_label(
                 predictions, labels, label_id)
 
@@ -113,11 +116,103 @@ class F1Score:
         if self.average == 'weighted':
             f1_score = torch.div(f1_score, len(labels))
         elif self.average == 'macro':
-            f1_score = torch.div(f1_score, len(labels.unique()))
+            f1_score = torch.div(f1_score, len(label_ids))
 
         return f1_score
 
 
+class ConfusionMatrix:
+    """
+    Streaming confusion matrix kept on the device of the predictions.
+
+    `update` only adds the counts of a batch, without reading anything back
+    to the host, precision, recall and F1 are derived once from the whole
+    matrix with `compute`. Like sklearn, the averages are taken over the
+    classes that occur in the labels or in the predictions and an undefined
+    ratio counts as 0.
+    """
+
+    def __init__(self, num_classes: int, average: str = 'macro', device: torch.device = None):
+        """
+        Init.
+
+        Args:
+            num_classes: number of classes
+            average: averaging method of `__call__`, micro, macro or weighted
+            device: device of the matrix, defaults to the one of the first batch
+        """
+        if average not in ['micro', 'macro', 'weighted']:
+            raise ValueError('Wrong value of average parameter')
+        self.num_classes = num_classes
+        self.average = average
+        self.matrix = None if device is None else torch.zeros(
+            (num_classes, num_classes), dtype=torch.long, device=device)
+
+    def reset(self) -> None:
+        if self.matrix is not None:
+            self.matrix.zero_()
+
+    def update(self, predictions: torch.Tensor, labels: torch.Tensor) -> None:
+        """
+        Add a batch, rows are labels and columns predictions.
+
+        Args:
+            predictions: tensor with predicted classes
+            labels: tensor with original labels
+        """
+        if self.matrix is None:
+            self.matrix = torch.zeros(
+                (self.num_classes, self.num_classes), dtype=torch.long, device=labels.device)
+        index = labels.flatten().long() * self.num_classes + predictions.flatten().long()
+        # a bincount of fixed length, torch.bincount syncs to size its output
+        self.matrix.view(-1).index_add_(0, index, torch.ones_like(index))
+
+    def all_reduce(self) -> "ConfusionMatrix":
+        """
+        Sum the matrices of every rank.
+        """
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(self.matrix)
+        return self
+
+    def compute(self) -> dict:
+        """
+        Precision, recall and F1 of every averaging method.
+
+        Returns:
+            {"{metric}_{average}": float} and "accuracy"
+        """
+        matrix = self.matrix.double()
+        true_positive = matrix.diagonal()
+        support, predicted = matrix.sum(dim=1), matrix.sum(dim=0)
+        precision = torch.nan_to_num(true_positive / predicted)
+        recall = torch.nan_to_num(true_positive / support)
+        f1 = torch.nan_to_num(2 * precision * recall / (precision + recall))
+        present = (support + predicted) > 0
+
+        accuracy = true_positive.sum() / matrix.sum().clamp(min=1)
+        results = torch.stack([accuracy] + [
+            value
+            for per_class in (precision, recall, f1)
+            for value in (
+                accuracy,
+                per_class[present].mean(),
+                (per_class * support).sum() / support.sum().clamp(min=1),
+            )
+        ]).tolist()
+
+        names = ['accuracy'] + ['{}_{}'.format(metric, average)
+                                for metric in ('precision', 'recall', 'f1')
+                                for average in ('micro', 'macro', 'weighted')]
+        return dict(zip(names, results))
+
+    def __call__(self) -> float:
+        """
+        F1 score of the averaging method defined in init.
+        """
+        return self.compute()['f1_{}'.format(self.average)]
+
+
 class F1_Loss(nn.Module):
     '''Calculate F1 score. Can work with gpu tensors
 
@@ -332,24 +427,37 @@ class Evaluation(object):
 
 
 def test_sk() -> None:
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     errors = 0
     for _ in range(10):
         labels = torch.randint(1, 10, (4096, 100)).flatten()
         predictions = torch.randint(1, 10, (4096, 100)).flatten()
         labels1 = labels.numpy()
         predictions1 = predictions.numpy()
-        print(labels.cuda().unique(), predictions.cuda().unique())
+        print(labels.to(device).unique(), predictions.to(device).unique())
+        confusion_matrix = ConfusionMatrix(10)
+        for batch in range(0, len(labels), 8192):
+            confusion_matrix.update(predictions[batch:batch + 8192].to(device),
+                                    labels[batch:batch + 8192].to(device))
+        streamed = confusion_matrix.compute()
         for av in ['micro', 'macro', 'weighted']:
             f1_metric = F1Score(av)
-            my_pred = f1_metric(predictions.cuda(), labels.cuda())
+            my_pred = f1_metric(predictions.to(device), labels.to(device))
 
             f1_pred = f1_score(labels1, predictions1, average=av)
             # print(my_pred, f1_pred)
-            if not np.isclose(my_pred.item(), f1_pred.item()):
+            if not np.isclose(my_pred.item(), float(f1_pred)):
                 print('!' * 50)
                 print(f1_pred, my_pred, av)
                 errors += 1
 
+            for metric, sk_metric in (('precision', precision_score), ('recall', recall_score), ('f1', f1_score)):
+                sk_pred = sk_metric(labels1, predictions1, average=av, zero_division=0)
+                if not np.isclose(streamed['{}_{}'.format(metric, av)], sk_pred):
+                    print('!' * 50)
+                    print(sk_pred, streamed['{}_{}'.format(metric, av)], metric, av)
+                    errors += 1
+
     if errors == 0:
         print('No errors!')
 
@@ -10,6 +10,9 @@ from torch import nn
 from torchviz import make_dot
 from einops import rearrange, repeat
 from einops.layers.torch import Rearrange
+from torch.utils.checkpoint import checkpoint_sequential
+
+from mypyfunc.backbones import feature_dim
 
 from collections import OrderedDict
 from typing import Callable
@@ -17,6 +20,21 @@ import warnings
 warnings.filterwarnings('ignore')
 
 
+def backbone(extractor: nn.Sequential, frames: torch.Tensor, segments: int = 0) -> torch.Tensor:
+    """ Per-frame CNN features, with `segments` only the segment inputs are
+        kept and the rest is recomputed in the backward pass
+    """
+    if not segments or not torch.is_grad_enabled():
+        return extractor(frames)
+    if tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 0):
+        return checkpoint_sequential(extractor, segments, frames, use_reentrant=False)
+    # torch 1.x only has the reentrant checkpoint, which back-propagates into
+    # a segment only when its input requires grad
+    if not frames.requires_grad:
+        frames = frames.detach().requires_grad_()
+    return checkpoint_sequential(extractor, segments, frames)
+
+
 class CNN_LSTM(nn.Module):
     def __init__(
         self,
@@ -26,6 +44,7 @@ class CNN_LSTM(nn.Module):
         hidden_dim: int,
         layer_dim: int,
         bidirectional=False,
+        checkpoint_segments: int = 0,
     ) -> None:
         super(CNN_LSTM, self).__init__()
         # Hidden dimensions
@@ -35,6 +54,8 @@ class CNN_LSTM(nn.Module):
         # Output dim classes
         self.output_dim = output_dim
         self.n_directions = 2 if bidirectional else 1
+        # Backbone segments recomputed in backward, 0 keeps every activation
+        self.checkpoint_segments = checkpoint_segments
 
         # Base cnn features layer
         self.extractor = cnn.features
@@ -54,7 +75,7 @@ class CNN_LSTM(nn.Module):
             self.layer_dim*self.n_directions,
             x.size(0),
             self.hidden_dim,
-            device="cuda"
+            device=x.device
         ).requires_grad_()
 
         # Initialize cell state
@@ -62,17 +83,22 @@ class CNN_LSTM(nn.Module):
             self.layer_dim*self.n_directions,
             x.size(0),
             self.hidden_dim,
-            device="cuda"
+            device=x.device
         ).requires_grad_()
         return h0, c0
 
-    def forward(self, x) -> torch.Tensor:
+    def extract_features(self, x: torch.Tensor) -> torch.Tensor:
         batch_size, chunk_size = x.shape[:2]
         # Get features (4,10,360,360,3)
-        out = self.extractor(x.flatten(end_dim=1))#.flatten(start_dim=1)
+        out = backbone(self.extractor, x.flatten(end_dim=1),
+                       self.checkpoint_segments)#.flatten(start_dim=1)
         out = self.avgpool(out).flatten(start_dim=1)
         # Shape back to batch x chunk
-        out = out.reshape((batch_size, chunk_size, out.shape[-1]))
+        return out.reshape((batch_size, chunk_size, out.shape[-1]))
+
+    def forward(self, x) -> torch.Tensor:
+        # (batch, chunk, features) inputs were extracted beforehand
+        out = self.extract_features(x) if x.dim() == 5 else x
         # One time step
         out, self.hidden_state = self.lstm(out, self.init_hidden(x))
         # Dense lstm
@@ -146,6 +172,8 @@ class Attention(nn.Module):
 
         self.heads = heads
         self.scale = dim_head ** -0.5
+        # fused kernel of torch >= 2.0, the math below otherwise
+        self.fused = hasattr(F, "scaled_dot_product_attention")
 
         self.attend = nn.Softmax(dim=-1)
         self.dropout = nn.Dropout(dropout)
@@ -157,17 +185,28 @@ class Attention(nn.Module):
             nn.Dropout(dropout)
         ) if project_out else nn.Identity()
 
-    def forward(self, x):
-        qkv = self.to_qkv(x).chunk(3, dim=-1)
-        q, k, v = map(lambda t: rearrange(
-            t, 'b n (h d) -> b h n d', h=self.heads), qkv)
+    def attention(self, q, k, v):
+        """
+        (batch, heads, tokens, dim_head) queries, keys and values to outputs
+        """
+        if self.fused:
+            # same default scale of dim_head ** -0.5
+            return F.scaled_dot_product_attention(
+                q, k, v, dropout_p=self.dropout.p if self.training else 0.)
 
         dots = torch.matmul(q, k.transpose(-1, -2)) * self.scale
 
         attn = self.attend(dots)
         attn = self.dropout(attn)
 
-        out = torch.matmul(attn, v)
+        return torch.matmul(attn, v)
+
+    def forward(self, x):
+        qkv = self.to_qkv(x).chunk(3, dim=-1)
+        q, k, v = map(lambda t: rearrange(
+            t, 'b n (h d) -> b h n d', h=self.heads), qkv)
+
+        out = self.attention(q, k, v)
         out = rearrange(out, 'b h n d -> b n (h d)')
         return self.to_out(out)
 
@@ -206,7 +245,8 @@ class CNN_Transformers(nn.Module):
         pool: str = 'cls',
         dim_head: int = 64,
         dropout: int = 0.,
-        emb_dropout: int = 0.
+        emb_dropout: int = 0.,
+        checkpoint_segments: int = 0
     ) -> None:
         super().__init__()
         image_height, image_width = pair(image_size)
@@ -223,8 +263,9 @@ class CNN_Transformers(nn.Module):
 
         self.extractor = cnn.features
         self.avgpool = cnn.avgpool
+        self.checkpoint_segments = checkpoint_segments
         self.fc = nn.Sequential(OrderedDict([
-            ('linear', nn.Linear(in_features=25088, out_features=dim)),
+            ('linear', nn.Linear(in_features=feature_dim(cnn, image_height), out_features=dim)),
             ('relu', nn.ReLU()),
             ('dropout', nn.Dropout(p=0.5, inplace=False)),
         ]))
@@ -245,12 +286,16 @@ class CNN_Transformers(nn.Module):
         )
         self.__initialization()
 
-    def forward(self, x):
+    def extract_features(self, x: torch.Tensor) -> torch.Tensor:
         batch_size, chunk_size = x.shape[:2]
-        x = self.extractor(x.flatten(end_dim=1))#.flatten(start_dim=1)
+        x = backbone(self.extractor, x.flatten(end_dim=1),
+                     self.checkpoint_segments)#.flatten(start_dim=1)
         x = self.avgpool(x).flatten(start_dim=1)
-        x = self.fc(x)
-        x = x.reshape((batch_size, chunk_size, x.shape[-1]))
+        return x.reshape((batch_size, chunk_size, x.shape[-1]))
+
+    def forward(self, x):
+        # (batch, chunk, features) inputs were extracted beforehand
+        x = self.fc(self.extract_features(x) if x.dim() == 5 else x)
         b, n, _ = x.shape
 
         cls_tokens = repeat(self.cls_token, '1 1 d -> b 1 d', b=b)
@@ -325,17 +370,23 @@ class OHEMLoss(nn.Module):
     ) -> torch.Tensor:
         if epoch < self.init_epoch:
             return self.criterion(pred,target)
-            
+
+        keep_idx = self.hard_examples(pred, target)
+        return self.kept_loss(pred[keep_idx], target[keep_idx], len(keep_idx))
+
+    def hard_examples(self, pred: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+        """ Indices of the samples of the largest losses, the ones kept """
         ohem_loss = F.cross_entropy(
             pred, target, reduction='none', ignore_index=-1)
-        sorted_ohem_loss, idx = torch.sort(ohem_loss, descending=True)
-        keep_num = min(sorted_ohem_loss.size()[0], self.__batch_size)
+        _, idx = torch.sort(ohem_loss, descending=True)
+        return idx[:min(ohem_loss.size()[0], self.__batch_size)]
 
-        if keep_num < sorted_ohem_loss.size()[0]:
-            keep_idx_cuda = idx[:keep_num]
-            ohem_loss = ohem_loss[keep_idx_cuda]
-
-        return ohem_loss.sum() / keep_num
+    def kept_loss(self, pred: torch.Tensor, target: torch.Tensor, keep_num: int) -> torch.Tensor:
+        """ Share of kept samples, e.g. a micro-batch of them, in the loss of
+            all `keep_num` kept samples
+        """
+        return F.cross_entropy(
+            pred, target, reduction='sum', ignore_index=-1) / keep_num
 
 def visualize_model(
     model:nn.Module,
@@ -354,12 +405,59 @@ def test_OHEM() -> None:
     print(criterion(cls_pred, cls_target))
 
 
+def test_attention() -> None:
+    """
+    The fused and the math attention agree on outputs and gradients
+    """
+    torch.manual_seed(0)
+    attention = Attention(dim=512, heads=8, dim_head=64).eval()
+    if not attention.fused:
+        print("scaled_dot_product_attention is not available, nothing to compare")
+        return
+    x = torch.randn(4, 11, 512, requires_grad=True)
+    results = []
+    for fused in (True, False):
+        attention.fused = fused
+        out = attention(x)
+        grad, = torch.autograd.grad(out.square().sum(), x)
+        results.append((out, grad))
+    (fused_out, fused_grad), (math_out, math_grad) = results
+    assert torch.allclose(fused_out, math_out, atol=1e-5), (fused_out - math_out).abs().max()
+    assert torch.allclose(fused_grad, math_grad, atol=1e-4), (fused_grad - math_grad).abs().max()
+    print("max |out| difference {:.2e}, max |grad| difference {:.2e}".format(
+        (fused_out - math_out).abs().max(), (fused_grad - math_grad).abs().max()))
+
+
+def benchmark_attention(repeats: int = 50) -> None:
+    """
+    CPU forward + backward time of the fused and the math attention, over the
+    (batch, heads, tokens, dim_head) of CNN_Transformers chunks and longer ones
+    """
+    import time
+    for shape in ((4, 8, 11, 64), (16, 8, 11, 64), (4, 8, 101, 64), (4, 8, 401, 64)):
+        batch, heads, tokens, dim_head = shape
+        attention = Attention(dim=heads * dim_head, heads=heads, dim_head=dim_head)
+        q, k, v = (torch.randn(shape, requires_grad=True) for _ in range(3))
+        timings = []
+        for fused in (True, False):
+            attention.fused = fused
+            attention.attention(q, k, v).sum().backward()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                attention.attention(q, k, v).sum().backward()
+            timings.append((time.perf_counter() - start) / repeats * 1e3)
+        print("{:>18} fused {:>7.3f} ms, math {:>7.3f} ms, speed-up {:.2f}x".format(
+            str(shape), *timings, timings[1] / timings[0]))
+
+
 if __name__ == '__main__':
     """
     torch.Size([4, 1000, 1024])
     https://discuss.pytorch.org/t/finding-model-size/130275
     """
     # test_OHEM()
+    # test_attention()
+    # benchmark_attention()
     flicker_path = '../data/flicker1/'
     model = CNN_Transformers(
         image_size=360,          # image size
@@ -1,5 +1,9 @@
+import os
+import queue
 import logging
 import random
+import tempfile
+import threading
 import torch
 import numpy as np
 
@@ -7,7 +11,7 @@ import numpy as np
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
-def save_checkpoint(save_path, model, optimizer, loss, f1, val_f1, val_loss):
+def save_checkpoint(save_path, model, optimizer, loss, f1, val_loss, val_f1, writer=None):
 
     if save_path == None:
         return
@@ -26,6 +30,9 @@ def save_checkpoint(save_path, model, optimizer, loss, f1, val_f1, val_loss):
     else:
         state_dict['model_state_dict'] = model.state_dict()
 
+    if writer is not None:
+        writer.save(save_path, state_dict)
+        return
     torch.save(state_dict, save_path)
     logging.info(f'Model saved to ==> {save_path}')
 
@@ -40,10 +47,10 @@ def load_checkpoint(load_path, model, optimizer):
     model.load_state_dict(state_dict['model_state_dict'])
     optimizer.load_state_dict(state_dict['optimizer_state_dict'])
 
-    return state_dict['loss'], state_dict['f1'], state_dict['valid_loss'], state_dict['valid_f1']
+    return state_dict['loss'], state_dict['f1'], state_dict['valid_loss'], state_dict['val_f1']
 
 
-def save_metrics(save_path, loss_callback, f1_callback, val_loss_callback, val_f1_callback):
+def save_metrics(save_path, loss_callback, f1_callback, val_loss_callback, val_f1_callback, writer=None):
 
     if save_path == None:
         return
@@ -53,6 +60,9 @@ def save_metrics(save_path, loss_callback, f1_callback, val_loss_callback, val_f
                   'val_loss_callback': val_loss_callback,
                   'val_f1_callback': val_f1_callback, }
 
+    if writer is not None:
+        writer.save(save_path, state_dict)
+        return
     torch.save(state_dict, save_path)
     logging.info(f'Model saved to ==> {save_path}')
 
@@ -87,3 +97,227 @@ def torch_seeding(seed=12345):
 
     if torch.cuda.is_available():
         torch.cuda.manual_seed_all(seed)
+
+
+def autocast(device, enabled=True):
+    """
+    float16 autocast on CUDA, bfloat16 on CPU where float16 kernels are slow
+    """
+    device = torch.device(device)
+    return torch.autocast(
+        device_type=device.type,
+        dtype=torch.float16 if device.type == "cuda" else torch.bfloat16,
+        enabled=enabled
+    )
+
+
+def grad_scaler(device, enabled=True):
+    """
+    Loss scaling against float16 gradient underflow, bfloat16 has the float32
+    exponent range so the scaler is a no-op off CUDA
+    """
+    enabled = enabled and torch.device(device).type == "cuda"
+    # torch.amp.GradScaler from torch 2.3 on, the CUDA one is deprecated there
+    if tuple(int(v) for v in torch.__version__.split(".")[:2]) < (2, 3):
+        return torch.cuda.amp.GradScaler(enabled=enabled)
+    return torch.amp.GradScaler("cuda", enabled=enabled)
+
+
+def reset_peak_memory(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory(device):
+    """
+    Peak allocated MB on CUDA since the last reset, peak resident MB of the
+    whole process otherwise, which cannot be reset
+    """
+    if torch.device(device).type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def saved_activations(forward):
+    """
+    MB of the tensors the autograd graph of `forward()` keeps for the
+    backward pass, the activation memory of a training step on any device
+    """
+    saved = 0
+
+    def pack(tensor):
+        nonlocal saved
+        saved += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        forward()
+    return saved / 2**20
+
+
+def init_distributed():
+    """
+    Process group of a torchrun launch, nccl with one GPU per process or gloo
+    on CPU. Returns (rank, world size, device).
+    """
+    import os
+    import torch.distributed as dist
+
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        device = torch.device(f"cuda:{local_rank}")
+    else:
+        device = torch.device("cpu")
+    dist.init_process_group(backend="nccl" if device.type == "cuda" else "gloo")
+    logging.info(f'Rank {dist.get_rank()} of {dist.get_world_size()} on {device}')
+    return dist.get_rank(), dist.get_world_size(), device
+
+
+def is_distributed():
+    return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+
+def is_main_process():
+    return not is_distributed() or torch.distributed.get_rank() == 0
+
+
+def reduce_mean(total, count, device):
+    """
+    total / count summed over every rank, the mean of all their samples, as
+    a float so that the callbacks never hold device tensors
+    """
+    if not is_distributed():
+        return float(total / max(count, 1))
+    values = torch.tensor([float(total), float(count)], device=device)
+    torch.distributed.all_reduce(values)
+    return (values[0] / values[1].clamp(min=1)).item()
+
+
+def snapshot(obj):
+    """
+    Copy of a (nested) state dict with every tensor cloned to CPU, safe to
+    write while training keeps updating the originals
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+class CheckpointWriter:
+    """Writes checkpoints from a background thread
+
+    `save` snapshots the state to CPU on the calling thread and returns, the
+    writer thread then saves it to a temporary file next to the target and
+    renames it, so a checkpoint on disk is always complete. At most
+    `max_pending` snapshots wait to be written, `save` blocks beyond that.
+    A failed write is raised by the next `save` or by `close`.
+
+    Args:
+        max_pending (:obj:`int`, optional): Snapshots held in memory.
+            Defaults to 1.
+
+    """
+
+    def __init__(self, max_pending=1):
+        self.__queue = queue.Queue(maxsize=max_pending)
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                self.__queue.task_done()
+                return
+            save_path, state_dict = item
+            try:
+                directory = os.path.dirname(os.path.abspath(save_path))
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "wb") as fh:
+                        torch.save(state_dict, fh)
+                        fh.flush()
+                        os.fsync(fh.fileno())
+                    os.replace(tmp_path, save_path)
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+                logging.info(f'Model saved to ==> {save_path}')
+            except Exception as e:
+                self.__error = e
+            finally:
+                self.__queue.task_done()
+
+    def __raise(self):
+        if self.__error is not None:
+            error, self.__error = self.__error, None
+            raise RuntimeError("Checkpoint write failed") from error
+
+    def save(self, save_path, state_dict):
+        self.__raise()
+        self.__queue.put((save_path, snapshot(state_dict)))
+
+    def wait(self):
+        """
+        Block until every submitted checkpoint is on disk
+        """
+        self.__queue.join()
+        self.__raise()
+
+    def close(self):
+        self.__queue.put(None)
+        self.__thread.join()
+        self.__raise()
+
+
+def training_state(epoch, model, optimizer, scheduler, scaler, callbacks, val_max_f1):
+    """
+    Everything a run needs to continue after `epoch` exactly as if it had not
+    stopped, the samplers draw from the python, numpy and torch generators
+    """
+    return {
+        'epoch': epoch,
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scheduler_state_dict': scheduler.state_dict(),
+        'scaler_state_dict': scaler.state_dict(),
+        'callbacks': callbacks,
+        'val_max_f1': val_max_f1,
+        'rng_state': {
+            'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        },
+    }
+
+
+def restore_training_state(load_path, model, optimizer, scheduler, scaler, map_location=None):
+    """
+    Load a `training_state` checkpoint in place, returns (next epoch,
+    callbacks, val_max_f1)
+    """
+    state_dict = torch.load(load_path, map_location=map_location or device, weights_only=False)
+    logging.info(f'Training state loaded from <== {load_path}')
+
+    model.load_state_dict(state_dict['model_state_dict'])
+    optimizer.load_state_dict(state_dict['optimizer_state_dict'])
+    scheduler.load_state_dict(state_dict['scheduler_state_dict'])
+    scaler.load_state_dict(state_dict['scaler_state_dict'])
+
+    rng_state = state_dict['rng_state']
+    random.setstate(rng_state['python'])
+    np.random.set_state(rng_state['numpy'])
+    torch.set_rng_state(rng_state['torch'].cpu())
+    if torch.cuda.is_available() and rng_state['cuda']:
+        torch.cuda.set_rng_state_all([state.cpu() for state in rng_state['cuda']])
+
+    return state_dict['epoch'] + 1, state_dict['callbacks'], state_dict['val_max_f1']
@@ -0,0 +1,230 @@
+import os
+import av
+import json
+import time
+import logging
+import numpy as np
+
+from typing import Dict, List, Tuple
+
+
+class PacketScanner:
+    """Flicker candidates from bitstream statistics, no frame is decoded
+
+    A full-screen flash or blank shows up as a keyframe off the regular GOP
+    (a solid frame is a tiny intra frame), as a spike in the encoded size of
+    the frame that follows it, or as a stall of the presentation timestamps
+    of variable frame rate screen recordings.
+
+    Args:
+        z_threshold (:obj:`float`, optional): Robust z-score (median / MAD)
+            above which a packet size or pts interval is a spike.
+            Defaults to 3.5.
+        size_ratio (:obj:`float`, optional): Min ratio between a spike and the
+            median size of its neighbourhood, which ignores the periodic size
+            pattern of the rate control. Defaults to 4.0.
+        window (:obj:`int`, optional): #frames on each side of the
+            neighbourhood. Defaults to 15.
+        margin (:obj:`int`, optional): #frames added on both sides of every
+            flagged frame before the ranges are merged. Defaults to 5.
+
+    """
+
+    def __init__(
+        self,
+        z_threshold: float = 3.5,
+        size_ratio: float = 4.0,
+        window: int = 15,
+        margin: int = 5
+    ) -> None:
+        self.__z_threshold = z_threshold
+        self.__size_ratio = size_ratio
+        self.__window = window
+        self.__margin = margin
+
+    @staticmethod
+    def scan(video_path: str) -> Dict[str, np.ndarray]:
+        """ Per-frame packet size, keyframe flag, pts and pts interval in
+            seconds, in presentation order
+        """
+        container = av.open(video_path)
+        try:
+            stream = container.streams.video[0]
+            packets = [
+                (packet.pts, packet.size, packet.is_keyframe)
+                for packet in container.demux(stream)
+                if packet.pts is not None and packet.size
+            ]
+            time_base = float(stream.time_base)
+        finally:
+            container.close()
+
+        packets.sort()
+        pts = np.array([p for p, _, _ in packets], dtype=np.float64) * time_base
+        return dict({
+            "sizes": np.array([s for _, s, _ in packets], dtype=np.int64),
+            "keyframes": np.array([k for _, _, k in packets], dtype=bool),
+            "pts": pts,
+            "intervals": np.diff(pts, prepend=pts[:1]),
+        })
+
+    @staticmethod
+    def robust_z(values: np.ndarray) -> np.ndarray:
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return values
+        median = np.median(values)
+        mad = 1.4826 * np.median(np.abs(values - median))
+        if mad == 0:
+            mad = values.std() or 1.0
+        return (values - median) / mad
+
+    def flags(self, statistics: Dict[str, np.ndarray]) -> np.ndarray:
+        """ Per-frame flags of size spikes, unexpected keyframes and pts stalls
+        """
+        sizes, keyframes, intervals = \
+            statistics["sizes"], statistics["keyframes"], statistics["intervals"]
+        flags = np.zeros(len(sizes), dtype=bool)
+
+        # keyframes are large anyway, only inter frames are compared
+        inter = np.flatnonzero(~keyframes)
+        if len(inter):
+            inter_sizes = sizes[inter].astype(np.float64)
+            padded = np.pad(inter_sizes, self.__window, mode="edge")
+            local = np.median(np.lib.stride_tricks.sliding_window_view(
+                padded, 2 * self.__window + 1), axis=1)
+            flags[inter] = (self.robust_z(inter_sizes) > self.__z_threshold) & \
+                (inter_sizes > self.__size_ratio * np.maximum(local, 1.0))
+
+        keys = np.flatnonzero(keyframes)
+        if len(keys) > 2:
+            gaps = np.diff(keys)
+            gop = np.median(gaps)
+            flags[keys[1:][gaps != gop]] = True
+
+        flags[1:] |= self.robust_z(intervals[1:]) > self.__z_threshold
+        return flags
+
+    def candidates(self, flags: np.ndarray) -> List[Tuple[int, int]]:
+        """ Merged, 0-indexed and inclusive (start, end) frame ranges around
+            the flagged frames
+        """
+        ranges = []
+        for index in np.flatnonzero(flags):
+            start = max(index - self.__margin, 0)
+            end = min(index + self.__margin, len(flags) - 1)
+            if ranges and start <= ranges[-1][1] + 1:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return [(int(start), int(end)) for start, end in ranges]
+
+    def __call__(self, video_path: str) -> List[Tuple[int, int]]:
+        start_time = time.perf_counter()
+        statistics = self.scan(video_path)
+        ranges = self.candidates(self.flags(statistics))
+        seconds = time.perf_counter() - start_time
+        duration = statistics["pts"][-1] - statistics["pts"][0] \
+            if len(statistics["pts"]) else 0.0
+        logging.info("{}: {} frames, {} candidate range(s) in {:.3f} second(s), {:.4f}x real time".format(
+            video_path, len(statistics["sizes"]), len(ranges), seconds,
+            seconds / duration if duration else float("nan")))
+        return ranges
+
+
+def evaluate(
+    scanner: PacketScanner,
+    videos_dir: str,
+    label_path: str = "data/multi_label.json"
+) -> Tuple[float, float]:
+    """ (recall of the labelled flicker frames, fraction of frames kept) over
+        every recording of `videos_dir` that has labels, with the 1-indexed
+        "{frame}_{video}" keys of multi_label.json
+    """
+    labelled = dict()
+    for key in json.load(open(label_path, "r")):
+        frame, video = key.split("_", 1)
+        labelled.setdefault(video, []).append(int(frame) - 1)
+
+    hits, total, kept, frames = 0, 0, 0, 0
+    for video, flicker_frames in labelled.items():
+        video_path = os.path.join(videos_dir, "{}.mp4".format(video))
+        if not os.path.exists(video_path):
+            continue
+        # one demux per video, the statistics give #frames as well
+        statistics = scanner.scan(video_path)
+        n_frames = len(statistics["sizes"])
+        inside = np.zeros(n_frames, dtype=bool)
+        for start, end in scanner.candidates(scanner.flags(statistics)):
+            inside[start:end + 1] = True
+        flicker_frames = [f for f in flicker_frames if f < n_frames]
+        hits += int(inside[flicker_frames].sum())
+        total += len(flicker_frames)
+        kept += int(inside.sum())
+        frames += n_frames
+
+    recall = hits / total if total else float("nan")
+    kept_ratio = kept / frames if frames else float("nan")
+    logging.info("recall {:.1%} of {} flicker frames, {:.1%} of {} frames kept".format(
+        recall, total, kept_ratio, frames))
+    return recall, kept_ratio
+
+
+def benchmark(
+    n_videos: int = 6,
+    n_frames: int = 600,
+    n_flickers: int = 3,
+    seed: int = 0
+) -> Tuple[float, float]:
+    """ `evaluate` on encoded screen-like recordings, scrolling with pauses
+        and I/P-only like the screen recorder, with `n_flickers` one-frame
+        white or black flashes each, labelled in the multi_label.json format
+    """
+    import tempfile
+
+    rng = np.random.default_rng(seed)
+    videos_dir = tempfile.mkdtemp()
+    labels = dict()
+    for v in range(n_videos):
+        texture = np.kron(rng.integers(0, 255, (60, 30, 3), dtype=np.uint8),
+                          np.ones((12, 12, 1), dtype=np.uint8))
+        flickers = rng.choice(np.arange(20, n_frames - 20), n_flickers, replace=False)
+        # scroll speed of every frame, 0 on pauses
+        speeds = np.repeat(rng.choice([0, 0, 2, 4, 8], n_frames // 30 + 1), 30)
+        container = av.open(os.path.join(videos_dir, "video{}.mp4".format(v)), "w")
+        stream = container.add_stream("libx264", rate=30, options={"bf": "0"})
+        stream.width, stream.height, stream.pix_fmt = 360, 720, "yuv420p"
+        offset = 0
+        for i in range(n_frames):
+            offset += speeds[i]
+            image = np.roll(texture, offset, axis=0)
+            if i in flickers:
+                image = np.full_like(image, 255 * (i % 2))
+            for packet in stream.encode(av.VideoFrame.from_ndarray(image, format="rgb24")):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+        container.close()
+        labels.update({"{}_video{}".format(f + 1, v): 1 for f in flickers})
+
+    label_path = os.path.join(videos_dir, "multi_label.json")
+    with open(label_path, "w") as fh:
+        json.dump(labels, fh)
+    start_time = time.perf_counter()
+    recall, kept_ratio = evaluate(PacketScanner(), videos_dir, label_path)
+    print("{} recordings of {} frames in {:.2f} second(s)".format(
+        n_videos, n_frames, time.perf_counter() - start_time))
+    return recall, kept_ratio
+
+
+if __name__ == "__main__":
+    """
+    python3 -m preprocessing.bitstream.packets data/lower_res [labels]
+    python3 -m preprocessing.bitstream.packets
+    """
+    import sys
+    if len(sys.argv) > 1:
+        recall, kept_ratio = evaluate(PacketScanner(), *sys.argv[1:3])
+    else:
+        recall, kept_ratio = benchmark()
+    print("recall {:.1%}, frames kept {:.1%}".format(recall, kept_ratio))
@@ -0,0 +1,110 @@
+import time
+import logging
+import numpy as np
+
+from typing import Iterable, Iterator, List, Tuple, Union
+
+
+class SolidColor:
+    """Vectorized detector of blank and solid-colour frames
+
+    A frame is solid when nearly all pixels of its strided downsample lie
+    within `tolerance` of its dominant (per-channel median) colour.
+
+    Args:
+        stride (:obj:`int`, optional): Sampling step along both axes.
+            Defaults to 16.
+        tolerance (:obj:`int`, optional): Max per-channel difference from the
+            dominant colour for a pixel to count as that colour. Defaults to 8.
+        min_ratio (:obj:`float`, optional): Min fraction of pixels of the
+            dominant colour for a frame to be solid, which leaves room for
+            status bars and compression noise. Defaults to 0.95.
+
+    """
+
+    def __init__(self, stride: int = 16, tolerance: int = 8, min_ratio: float = 0.95) -> None:
+        self.__stride = stride
+        self.__tolerance = tolerance
+        self.__min_ratio = min_ratio
+
+    def __samples(self, images: np.ndarray) -> np.ndarray:
+        return images[..., ::self.__stride, ::self.__stride, :].reshape(
+            images.shape[:-3] + (-1, 3))
+
+    def __classify(self, samples: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        samples = samples.astype(np.int16)
+        colors = np.median(samples, axis=1).astype(np.int16)
+        within = np.abs(samples - colors[:, None]).max(
+            axis=-1) <= self.__tolerance
+        flags = within.mean(axis=1) >= self.__min_ratio
+        return flags, colors.astype(np.uint8)
+
+    def detect(self, images: Union[np.ndarray, List[np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Args:
+            images (:obj:`np.ndarray`): A (N, H, W, 3) uint8 batch, a list of
+                (H, W, 3) frames, or a single (H, W, 3) frame.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: (N,) solid-colour flags and the
+            (N, 3) uint8 dominant colour of every frame
+
+        """
+        if isinstance(images, (list, tuple)):
+            # sample before stacking instead of copying the full frames
+            return self.__classify(np.stack([
+                self.__samples(np.asarray(image)) for image in images]))
+        images = np.asarray(images)
+        assert images.ndim in (3, 4) and images.shape[-1] == 3, \
+            "images should be an array of image with shape (height, width, 3)"
+        if images.ndim == 3:
+            flags, colors = self.__classify(self.__samples(images)[None])
+            return flags[0], colors[0]
+        return self.__classify(self.__samples(images))
+
+    def stream(
+        self,
+        frames_iter: Iterable[np.ndarray],
+        batch_size: int = 64
+    ) -> Iterator[Tuple[bool, np.ndarray]]:
+        """ Yield (flag, dominant colour) of every frame in order. Only the
+            strided samples of a frame are kept, so a batch never holds the
+            full frames in memory.
+        """
+        batch = []
+        for frame in frames_iter:
+            batch.append(self.__samples(frame))
+            if len(batch) == batch_size:
+                yield from zip(*self.__classify(np.stack(batch)))
+                batch = []
+        if batch:
+            yield from zip(*self.__classify(np.stack(batch)))
+
+
+def benchmark(n_frames: int = 1024, shape: tuple = (720, 360, 3), batch_size: int = 64) -> None:
+    """ Throughput and accuracy on synthetic frames, every other frame is a
+        solid colour with a noisy status bar
+    """
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 255, (n_frames,) + shape, dtype=np.uint8)
+    truth = np.arange(n_frames) % 2 == 0
+    frames[truth] = rng.integers(0, 255, (truth.sum(), 1, 1, 3), dtype=np.uint8)
+    frames[truth, :24] = rng.integers(0, 255, (truth.sum(), 24) + shape[1:],
+                                      dtype=np.uint8)
+
+    detector = SolidColor()
+    start = time.perf_counter()
+    flags = np.array([flag for flag, _ in detector.stream(
+        iter(frames), batch_size=batch_size)])
+    seconds = time.perf_counter() - start
+    logging.info("SolidColor: {} frames in {:.2f} second(s)".format(
+        n_frames, seconds))
+    print("{:.1f} frames/s, accuracy {:.3f}".format(
+        n_frames / seconds, np.mean(flags == truth)))
+
+
+if __name__ == "__main__":
+    """
+    python3 -m preprocessing.color.solid_color
+    """
+    benchmark()
@@ -0,0 +1,89 @@
+import cv2
+import hashlib
+import logging
+import numpy as np
+
+from typing import Sequence, Tuple
+
+
+class FrameHash:
+    """Run-length encoding of repeated frames with a cheap frame hash
+
+    Args:
+        hash_size (:obj:`tuple`, optional): (width, height) of the downsampled
+            frame being hashed. Defaults to (64, 64).
+        threshold (:obj:`int`, optional): Max hamming distance between two
+            perceptual (difference) hashes for a frame to count as repeated.
+            0 compares an exact digest of the downsampled frame instead.
+            Defaults to 0.
+
+    """
+
+    def __init__(self, hash_size: tuple = (64, 64), threshold: int = 0) -> None:
+        self.__hash_size = hash_size
+        self.__threshold = threshold
+        self.reset()
+
+    def reset(self) -> None:
+        self.__run_digest = None
+        self.run_lengths = []
+
+    def digest(self, image: np.ndarray):
+        if self.__threshold:
+            # difference hash, one bit per horizontal gradient sign
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            small = cv2.resize(gray, (self.__hash_size[0] + 1, self.__hash_size[1]),
+                               interpolation=cv2.INTER_AREA)
+            return np.packbits(small[:, 1:] > small[:, :-1])
+        small = cv2.resize(image, self.__hash_size,
+                           interpolation=cv2.INTER_AREA)
+        return hashlib.blake2b(small.tobytes(), digest_size=16).digest()
+
+    def is_repeat(self, image: np.ndarray) -> bool:
+        """ Hash the next frame of the stream and extend the current run
+            if it repeats the first frame of that run
+        """
+        digest = self.digest(image)
+
+        if self.__run_digest is None:
+            repeat = False
+        elif self.__threshold:
+            repeat = int(np.unpackbits(
+                self.__run_digest ^ digest).sum()) <= self.__threshold
+        else:
+            repeat = self.__run_digest == digest
+
+        if repeat:
+            self.run_lengths[-1] += 1
+        else:
+            self.__run_digest = digest
+            self.run_lengths.append(1)
+        return repeat
+
+    @property
+    def n_frames(self) -> int:
+        return int(np.sum(self.run_lengths))
+
+    @property
+    def skip_ratio(self) -> float:
+        return 1 - len(self.run_lengths) / self.n_frames if self.run_lengths else 0.0
+
+    def expand(self, unique: Sequence[np.ndarray]) -> np.ndarray:
+        """ Rebuild the per-frame array from one entry per run
+        """
+        return np.repeat(
+            np.asarray(unique),
+            self.run_lengths[:len(unique)],
+            axis=0
+        )
+
+    def report(self, name: str, embed_seconds: float) -> Tuple[float, float]:
+        """ Log the skip ratio and the embedding time saved by skipping,
+            estimated from the mean time per embedded frame
+        """
+        n_unique = len(self.run_lengths)
+        saved_seconds = (self.n_frames - n_unique) * \
+            embed_seconds / max(n_unique, 1)
+        logging.info("{}: embedded {}/{} frames, skip ratio = {:.2%}, saved ~{:.2f} second(s)".format(
+            name, n_unique, self.n_frames, self.skip_ratio, saved_seconds))
+        return self.skip_ratio, saved_seconds
@@ -2,9 +2,17 @@ from email.mime import base
 import os
 import cv2
 import json
+import time
+import queue
+import shutil
+import hashlib
+import logging
+import threading
 import numpy as np
 import tensorflow as tf
 
+from typing import Iterable, Iterator
+
 from tensorflow.keras import metrics
 from tensorflow.keras import layers
 from tensorflow.keras import Model
@@ -18,14 +26,84 @@ class Facenet:
     https://ideone.com/cJoN3x
     """
 
-    def __init__(self) -> None:
+    def __init__(self, use_cache: bool = False, cache_dir: str = None) -> None:
+        """
+        Args:
+            use_cache (:obj:`bool`, optional): Load the embedding network from
+                a SavedModel exported on the first run instead of assembling
+                the whole siamese model. Restoring it is slower than building
+                on CPU with TF 2.10, see benchmark_startup. Defaults to False.
+            cache_dir (:obj:`str`, optional): Directory of the exported
+                SavedModels. Defaults to models/cache next to the weights.
+        """
 
         super().__init__()
 
+        start = time.perf_counter()
+
         self.__target_shape = (200, 200)
+        self.__saved_embedding = None
 
         np.random.seed(0)
 
+        model_base_dir = os.path.join("preprocessing", "embedding", "models")
+        model_settings_path = os.path.join(model_base_dir, "model.json")
+
+        model_settings = json.load(open(model_settings_path, "r"))
+        model_path = os.path.join(model_base_dir, model_settings["name"])
+
+        if not os.path.exists(model_path):
+            raise NotImplementedError
+
+        export_path = os.path.join(
+            cache_dir or os.path.join(model_base_dir, "cache"), "embedding-{}".format(
+                self.__export_key(model_settings_path, model_path)))
+
+        if use_cache and os.path.exists(export_path):
+            # the root owns the restored variables the embed function reads
+            self.__saved_embedding = tf.saved_model.load(export_path)
+            logging.info("Facenet loaded from {} in {:.2f} second(s)".format(
+                export_path, time.perf_counter() - start))
+            return
+
+        self.__build(model_path)
+
+        if use_cache:
+            self.__export(export_path)
+
+        logging.info("Facenet built in {:.2f} second(s)".format(
+            time.perf_counter() - start))
+
+    @staticmethod
+    def __export_key(model_settings_path: str, model_path: str) -> str:
+        md5 = hashlib.md5()
+        with open(model_settings_path, "rb") as fh:
+            md5.update(fh.read())
+        # the weights may be replaced under the same name
+        stat = os.stat(model_path)
+        md5.update("{}-{}".format(stat.st_size, stat.st_mtime_ns).encode())
+        return md5.hexdigest()
+
+    def __export(self, export_path: str) -> None:
+        module = tf.Module()
+        module.embedding = self.__embedding
+        module.embed = self.__compiled_embedding
+
+        # export next to the destination and rename so that a killed run
+        # never leaves a partial SavedModel behind
+        tmp_path = "{}.{}.tmp".format(export_path, os.getpid())
+        try:
+            tf.saved_model.save(module, tmp_path)
+            os.replace(tmp_path, export_path)
+            logging.info("Facenet embedding exported to {}".format(export_path))
+        except OSError as e:
+            # another process finished the export first
+            logging.debug("Facenet export skipped: {}".format(repr(e)))
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def __build(self, model_path: str) -> None:
+
         base_cnn = self.adaptive_mobilenet()
 
         adaptive_1 = AdaptiveMaxPooling3D(
@@ -36,6 +114,13 @@ class Facenet:
         self.__embedding = Model(
             base_cnn.input, output, name="Embedding")
 
+        self.__compiled_embedding = tf.function(
+            lambda images: self.__embedding(
+                resnet.preprocess_input(images), training=False),
+            input_signature=[tf.TensorSpec(
+                shape=(None,) + self.__target_shape + (3,), dtype=tf.float32)]
+        )
+
         with open('preprocessing/embedding/models/embedding_summary.txt', 'w') as fh:
             self.__embedding.summary(print_fn=lambda x: fh.write(x + '\n'))
 
@@ -83,17 +168,12 @@ class Facenet:
         with open('preprocessing/embedding/models/siamese_adaptive_summary.txt', 'w') as fh:
             self.__siamese_model.summary(print_fn=lambda x: fh.write(x + '\n'))
 
-        model_base_dir = os.path.join("preprocessing", "embedding", "models")
-
-        model_settings = json.load(
-            open(os.path.join(model_base_dir, "model.json"), "r")
-        )
-        model_path = os.path.join(model_base_dir, model_settings["name"])
+        self.__siamese_model.load_weights(model_path)
 
-        if os.path.exists(model_path):
-            self.__siamese_model.load_weights(model_path)
-        else:
-            raise NotImplementedError
+    def __embed(self, images: tf.Tensor) -> tf.Tensor:
+        if self.__saved_embedding is not None:
+            return self.__saved_embedding.embed(images)
+        return self.__compiled_embedding(images)
 
     def get_embedding(self, images: np.ndarray, batched=True) -> np.ndarray:
         assert (not batched) or len(
@@ -103,7 +183,57 @@ class Facenet:
         resized_images = np.array([cv2.resize(image, dsize=self.__target_shape,
                                               interpolation=cv2.INTER_CUBIC) for image in images])
         image_tensor = tf.convert_to_tensor(resized_images, np.float32)
-        return self.__embedding(resnet.preprocess_input(image_tensor)).numpy()
+        return self.__embed(image_tensor).numpy()
+
+    def embed_stream(self, frames_iter: Iterable[np.ndarray], batch_size: int = 32) -> Iterator[np.ndarray]:
+        """ Yield the embedding of every frame in order. Frames are resized
+            into batches on a worker thread while the compiled embedding
+            runs on the previous batch.
+        """
+        batches = queue.Queue(maxsize=2)
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def resize() -> None:
+            try:
+                batch = np.empty((batch_size,) + self.__target_shape + (3,),
+                                 dtype=np.float32)
+                count = 0
+                for frame in frames_iter:
+                    batch[count] = cv2.resize(frame, dsize=self.__target_shape,
+                                              interpolation=cv2.INTER_CUBIC)
+                    count += 1
+                    if count == batch_size:
+                        if not put(batch):
+                            return
+                        batch = np.empty_like(batch)
+                        count = 0
+                if count:
+                    put(batch[:count])
+                put(None)
+            except Exception as e:
+                put(e)
+
+        worker = threading.Thread(target=resize, daemon=True)
+        worker.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield from self.__embed(tf.convert_to_tensor(batch)).numpy()
+        finally:
+            stop.set()
 
     def adaptive_mobilenet(self):
         base_cnn = mobilenet.MobileNet(
@@ -131,6 +261,91 @@ class Facenet:
         return new_model
 
 
+def test_embed_stream(
+    facenet: Facenet,
+    n_frames: int = 37,
+    batch_size: int = 8,
+    shape: tuple = (720, 360, 3)
+) -> None:
+    """ embed_stream yields the embeddings of get_embedding in input order,
+        over a last partial batch, and closing it early stops the worker
+        before it drains an endless frame iterator
+    """
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 255, (n_frames,) + shape, dtype=np.uint8)
+    streamed = np.array(list(facenet.embed_stream(iter(frames), batch_size=batch_size)))
+    expected = np.concatenate([
+        facenet.get_embedding(frames[i:i + batch_size])
+        for i in range(0, n_frames, batch_size)
+    ])
+    assert streamed.shape == expected.shape, (streamed.shape, expected.shape)
+    assert np.allclose(streamed, expected, atol=1e-4), np.abs(streamed - expected).max()
+
+    consumed = 0
+
+    def endless():
+        nonlocal consumed
+        while True:
+            consumed += 1
+            yield frames[consumed % n_frames]
+
+    threads = threading.active_count()
+    stream = facenet.embed_stream(endless(), batch_size=batch_size)
+    for _ in range(batch_size + 1):
+        next(stream)
+    stream.close()
+    deadline = time.perf_counter() + 5
+    while threading.active_count() > threads and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    stopped_at = consumed
+    time.sleep(0.5)
+    assert threading.active_count() == threads, "the resize worker is still running"
+    # two queued batches, the one being filled and the one put() holds
+    assert consumed == stopped_at <= batch_size * 5, consumed
+    print("{} frames in order, worker stopped after {} frames".format(
+        n_frames, consumed))
+
+
+def benchmark_embed_stream(
+    facenet: Facenet,
+    batch_sizes: tuple = (1, 8, 32, 64),
+    n_frames: int = 512,
+    shape: tuple = (720, 360, 3)
+) -> None:
+    frames = np.random.default_rng(0).integers(
+        0, 255, (n_frames,) + shape, dtype=np.uint8)
+    # trace the compiled embedding once before timing
+    next(facenet.embed_stream(iter(frames[:1]), batch_size=1))
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        for _ in facenet.embed_stream(iter(frames), batch_size=batch_size):
+            pass
+        print("batch size {:>4}: {:.1f} frames/s".format(
+            batch_size, n_frames / (time.perf_counter() - start)))
+
+
+def benchmark_startup() -> None:
+    """ Time to the first embedding of assembling the siamese model vs
+        loading the exported embedding, the first cached run also pays for
+        the export. The build only traces on the first call.
+    """
+    import tempfile
+
+    frame = np.zeros((1, 720, 360, 3), dtype=np.uint8)
+    # an empty cache of its own, the one of models/cache is left alone
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for label, use_cache in (("build", False), ("build + export", True), ("cached", True)):
+            start = time.perf_counter()
+            facenet = Facenet(use_cache=use_cache, cache_dir=cache_dir)
+            constructed = time.perf_counter() - start
+            facenet.get_embedding(frame)
+            print("{:>16}: {:.2f} second(s), first embedding after {:.2f}".format(
+                label, constructed, time.perf_counter() - start))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
 class DistanceLayer(layers.Layer):
 
     def __init__(self, **kwargs):
@@ -182,3 +397,13 @@ class SiameseModel(Model):
     @property
     def metrics(self):
         return [self.loss_tracker]
+
+
+if __name__ == "__main__":
+    """
+    python3 -m preprocessing.embedding.facenet
+    """
+    benchmark_startup()
+    facenet = Facenet()
+    test_embed_stream(facenet)
+    benchmark_embed_stream(facenet)
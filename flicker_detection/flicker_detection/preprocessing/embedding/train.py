@@ -2,6 +2,7 @@ from genericpath import exists
 import os
 import cv2
 import random
+import argparse
 import numpy as np
 import tensorflow as tf
 import matplotlib.pyplot as plt
@@ -40,6 +41,38 @@ def preprocess_triplets(anchor, positive, negative):
     )
 
 
+def preprocess_pair(anchor, positive, label):
+    return (
+        preprocess_image(anchor),
+        preprocess_image(positive),
+        label,
+    )
+
+
+def pair_dataset(anchors, positives, labels, batch_size=32, shuffle=False, cache_file=""):
+    """Batches of `batch_size` images made of `batch_size // 2` (anchor,
+    positive) pairs, labelled by their pair index for in-batch mining.
+
+    Decoded and resized images are cached after the first epoch, in memory
+    or in `cache_file`.
+    """
+    dataset = tf.data.Dataset.from_tensor_slices((anchors, positives, labels))
+    dataset = dataset.map(
+        preprocess_pair, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.cache(cache_file)
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=1024)
+    dataset = dataset.batch(batch_size // 2, drop_remainder=False)
+    dataset = dataset.map(
+        lambda anchor, positive, label: (
+            tf.concat([anchor, positive], axis=0),
+            tf.concat([label, label], axis=0),
+        ),
+        num_parallel_calls=tf.data.AUTOTUNE
+    )
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
 # We need to make sure both the anchor and positive images are loaded in
 # sorted order so we can match them together.
 anchor_images = sorted(
@@ -52,6 +85,15 @@ positive_images = sorted(
 
 image_count = len(anchor_images)
 
+# Every (anchor, positive) pair is its own identity, the split is taken
+# before the lists below are shuffled in place.
+pair_labels = np.arange(image_count)
+pair_splits = [
+    (anchor_images[s], positive_images[s], pair_labels[s])
+    for s in (slice(None, round(image_count * 0.8)),
+              slice(round(image_count * 0.8), None))
+]
+
 anchor_dataset = tf.data.Dataset.from_tensor_slices(anchor_images)
 positive_dataset = tf.data.Dataset.from_tensor_slices(positive_images)
 
@@ -70,17 +112,17 @@ negative_dataset = negative_dataset.shuffle(buffer_size=4096)
 dataset = tf.data.Dataset.zip(
     (anchor_dataset, positive_dataset, negative_dataset))
 dataset = dataset.shuffle(buffer_size=1024)
-dataset = dataset.map(preprocess_triplets)
+dataset = dataset.map(preprocess_triplets, num_parallel_calls=tf.data.AUTOTUNE)
 
 # Let's now split our dataset in train and validation.
 train_dataset = dataset.take(round(image_count * 0.8))
 val_dataset = dataset.skip(round(image_count * 0.8))
 
 train_dataset = train_dataset.batch(32, drop_remainder=False)
-train_dataset = train_dataset.prefetch(8)
+train_dataset = train_dataset.prefetch(tf.data.AUTOTUNE)
 
 val_dataset = val_dataset.batch(32, drop_remainder=False)
-val_dataset = val_dataset.prefetch(8)
+val_dataset = val_dataset.prefetch(tf.data.AUTOTUNE)
 
 
 def visualize(anchor, positive, negative):
@@ -200,9 +242,141 @@ class SiameseModel(Model):
         return [self.loss_tracker]
 
 
+def pairwise_distances(embeddings):
+    """Squared euclidean distance between every two embeddings of a batch"""
+    embeddings = tf.reshape(embeddings, (tf.shape(embeddings)[0], -1))
+    dot_product = tf.matmul(embeddings, embeddings, transpose_b=True)
+    square_norm = tf.linalg.diag_part(dot_product)
+    distances = square_norm[:, None] - 2.0 * \
+        dot_product + square_norm[None, :]
+    return tf.maximum(distances, 0.0)
+
+
+def batch_hard_triplet_loss(labels, embeddings, margin):
+    """Hardest positive and hardest negative of every anchor in the batch"""
+    distances = pairwise_distances(embeddings)
+    same = tf.equal(labels[:, None], labels[None, :])
+    not_self = tf.logical_not(tf.eye(tf.shape(labels)[0], dtype=tf.bool))
+
+    positive_mask = tf.cast(tf.logical_and(same, not_self), distances.dtype)
+    hardest_positive = tf.reduce_max(distances * positive_mask, axis=1)
+
+    # push the positives out of the running for the closest negative
+    max_distance = tf.reduce_max(distances, axis=1, keepdims=True)
+    hardest_negative = tf.reduce_min(
+        distances + max_distance * tf.cast(same, distances.dtype), axis=1)
+
+    return tf.reduce_mean(
+        tf.maximum(hardest_positive - hardest_negative + margin, 0.0))
+
+
+def batch_all_triplet_loss(labels, embeddings, margin):
+    """Mean over every valid (anchor, positive, negative) triplet of the batch
+    that still violates the margin"""
+    distances = pairwise_distances(embeddings)
+    same = tf.equal(labels[:, None], labels[None, :])
+    not_self = tf.logical_not(tf.eye(tf.shape(labels)[0], dtype=tf.bool))
+
+    valid = tf.logical_and(
+        tf.logical_and(same, not_self)[:, :, None],
+        tf.logical_not(same)[:, None, :]
+    )
+    triplet_loss = distances[:, :, None] - distances[:, None, :] + margin
+    triplet_loss = tf.maximum(
+        triplet_loss * tf.cast(valid, distances.dtype), 0.0)
+
+    n_positive = tf.reduce_sum(tf.cast(triplet_loss > 1e-16, distances.dtype))
+    return tf.reduce_sum(triplet_loss) / (n_positive + 1e-16)
+
+
+MINING_LOSSES = {
+    "hard": batch_hard_triplet_loss,
+    "all": batch_all_triplet_loss,
+}
+
+
+class OnlineTripletModel(Model):
+    """Embeds every image of a batch once and mines the triplets from the
+    in-batch distance matrix, instead of three passes per triplet.
+
+    The weights are tracked through `siamese_network` exactly like
+    `SiameseModel`, so the saved checkpoints are interchangeable.
+    """
+
+    def __init__(self, siamese_network, margin=0.5, mining="hard"):
+        super(OnlineTripletModel, self).__init__()
+        self.siamese_network = siamese_network
+        self.margin = margin
+        self.mining = mining
+        self.loss_tracker = metrics.Mean(name="loss")
+
+    @property
+    def embedding(self):
+        return self.siamese_network.get_layer("Embedding")
+
+    def call(self, inputs):
+        return self.embedding(resnet.preprocess_input(inputs))
+
+    def train_step(self, data):
+        with tf.GradientTape() as tape:
+            loss = self._compute_loss(data)
+
+        gradients = tape.gradient(loss, self.siamese_network.trainable_weights)
+
+        self.optimizer.apply_gradients(
+            zip(gradients, self.siamese_network.trainable_weights)
+        )
+
+        self.loss_tracker.update_state(loss)
+        return {"loss": self.loss_tracker.result()}
+
+    def test_step(self, data):
+        loss = self._compute_loss(data)
+
+        self.loss_tracker.update_state(loss)
+        return {"loss": self.loss_tracker.result()}
+
+    def _compute_loss(self, data):
+        images, labels = data
+        return MINING_LOSSES[self.mining](labels, self(images), self.margin)
+
+    @property
+    def metrics(self):
+        return [self.loss_tracker]
+
+
 if __name__ == "__main__":
 
-    siamese_model = SiameseModel(siamese_network)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--mining", type=str, choices=["none", "hard", "all"], default="none",
+        help="mine triplets inside each batch of pairs instead of training on fixed triplets"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=32,
+        help="#images per batch when mining"
+    )
+    parser.add_argument(
+        "--cache_file", type=str, default="",
+        help="file to cache the decoded images in, in memory if empty"
+    )
+    args = parser.parse_args()
+
+    if args.mining == "none":
+        siamese_model = SiameseModel(siamese_network)
+    else:
+        siamese_model = OnlineTripletModel(
+            siamese_network, mining=args.mining)
+        train_dataset, val_dataset = (
+            pair_dataset(
+                *split,
+                batch_size=args.batch_size,
+                shuffle=shuffle,
+                cache_file=args.cache_file and "{}.{}".format(
+                    args.cache_file, name)
+            )
+            for split, shuffle, name in zip(pair_splits, (True, False), ("train", "val"))
+        )
     filepath = "facenet_model.lite.h5"
 
     siamese_model.compile(optimizer=optimizers.Adam(0.0001))
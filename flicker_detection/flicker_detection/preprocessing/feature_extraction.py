@@ -1,19 +1,60 @@
-import os
 import gc
 import cv2
 import time
-import hashlib
 import logging
 import numpy as np
 
-from typing import List
+from typing import Iterable, List, Sequence
 
-from preprocessing.movement.brisk import Brisk
+from preprocessing.movement.global_motion import motion_estimator
 from preprocessing.embedding.facenet import Facenet
 from preprocessing.tranformation.affine import Affine
 from preprocessing.partition.pixel import Pixel
-from util.utils import parse_fps, take_snapshots, euclidean_distance
-from core.flicker import fullscreen_same_color
+from preprocessing.deduplication.frame_hash import FrameHash
+from preprocessing.color.solid_color import SolidColor
+from preprocessing.pipeline import Pipeline, Stage
+from mypyfunc.feature_cache import FeatureCache
+from util.utils import parse_fps, take_snapshots
+
+
+def lagged_distances(
+    embeddings: np.ndarray,
+    lags: Sequence[int],
+    length: int = None,
+    dtype: np.dtype = None
+) -> np.ndarray:
+    """Euclidean distances between every frame and the frames `lags` after it
+
+    Args:
+        embeddings (:obj:`np.ndarray`): Per-frame embeddings, (#frames, ...).
+        lags (:obj:`Sequence[int]`): Frame offsets to compare with.
+        length (:obj:`int`, optional): #frames compared. Defaults to every
+            frame that has all lags within the video.
+        dtype (:obj:`np.dtype`, optional): Computation dtype, e.g. np.float32.
+            Defaults to the dtype of the embeddings.
+
+    Returns:
+        np.ndarray: A (len(lags), length) matrix whose [j, i] entry is the
+        distance between frame i and frame i + lags[j]
+
+    """
+    embeddings = np.asarray(embeddings)
+    embeddings = embeddings.reshape(embeddings.shape[0], -1).astype(
+        dtype or embeddings.dtype, copy=False)
+    lags = np.asarray(lags)
+    if length is None:
+        length = embeddings.shape[0] - lags.max()
+    length = max(length, 0)
+
+    # one (length, D) difference per lag, a (lags, length, D) one would be
+    # gigabytes for long recordings
+    return np.array([
+        np.linalg.norm(
+            embeddings[:length] - embeddings[lag:lag + length],
+            axis=-1
+        )
+        for lag in lags
+    ]).reshape(len(lags), length)
 
 
 class Features:
@@ -22,6 +63,12 @@ class Features:
     Args:
         video_path (:obj:`str`): The path to the video file.
         limit (:obj:`int`, optional): Max #frames to take. Defaults to np.inf.
+        embed_batch_size (:obj:`int`, optional): #frames per embedding call
+            of the extraction pipeline. Defaults to 16.
+        queue_size (:obj:`int`, optional): Capacity of each stage queue of the
+            extraction pipeline. Defaults to 64.
+        motion (:obj:`str`, optional): Global-motion estimator, one of
+            "brisk", "phase" or "flow". Defaults to "brisk".
 
     Returns:
         np.ndarray: A numpy array that includes all frames
@@ -34,14 +81,21 @@ class Features:
         video_path: str,
         img_dir: str,
         enable_cache: bool,
-        cache_dir: str
+        cache_dir: str,
+        embed_batch_size: int = 16,
+        queue_size: int = 64,
+        motion: str = "brisk"
     ) -> None:
         self.facenet = facenet
         self.__video_path = video_path
         self.fps = parse_fps(self.__video_path)
         self.__img_dir = img_dir
         self.__cache_dir = cache_dir
-        self.__enable_cache = enable_cache
+        self.__feature_cache = FeatureCache(
+            cache_dir, namespace="features-{}".format(motion)) if enable_cache else None
+        self.__embed_batch_size = embed_batch_size
+        self.__queue_size = queue_size
+        self.__motion = motion
 
     def __get_affine_types(
         self,
@@ -73,79 +127,91 @@ class Features:
         )
         return pixel_result
 
-    def __extract(self) -> List[np.ndarray]:
+    def __frames(self) -> Iterable[np.ndarray]:
+        vidcap = cv2.VideoCapture(self.__video_path)
+        success, image = vidcap.read()
+        while success:
+            yield image
+            success, image = vidcap.read()
+        vidcap.release()
 
-        md5 = hashlib.md5(open(self.__video_path, 'rb').read()).hexdigest()
-        cache_data_path = os.path.join(self.__cache_dir, "{}.npz".format(md5))
+    def __extract(self) -> List[np.ndarray]:
 
-        if self.__enable_cache and os.path.exists(cache_data_path):
-            __cache = np.load(cache_data_path)
-            embeddings, suspects, \
-                horizontal_displacements, vertical_displacements = [
-                    __cache[__cache.files[i]]
-                    for i in range(len(__cache.files))
+        __cache = None
+        if self.__feature_cache is not None:
+            cache_key = self.__feature_cache.key(self.__video_path)
+            __cache = self.__feature_cache.load(cache_key)
+
+        names = ("embeddings", "suspects", "horizontal_displacements",
+                 "vertical_displacements", "solid_flags")
+        if __cache is not None and not all(name in __cache for name in names):
+            # written before every feature was cached
+            __cache = None
+
+        if __cache is not None:
+            embeddings, suspects, horizontal_displacements, \
+                vertical_displacements, solid_flags = [
+                    __cache[name] for name in names
                 ]
-            logging.info("Cache exists, using cache")
 
         else:
 
-            brisk = Brisk()
-
-            vidcap = cv2.VideoCapture(self.__video_path)
-            success, image = vidcap.read()
-            last_frame = image
-            last_embedding = self.facenet.get_embedding(image, batched=False)
-
-            embeddings = list()
-            similarities = list()
-            horizontal_displacements = list()
-            vertical_displacements = list()
-
-            count = 0
-            while success:
-                embeddings.append(last_embedding)
-
-                success, image = vidcap.read()
-
-                try:
-                    embedding = self.facenet.get_embedding(image, batched=False)
-                except Exception as e:
-                    logging.debug("{}".format(repr(e)))
-                    break
-
-                similarities.append(
-                    euclidean_distance(last_embedding, embedding)
-                )
-                delta_x, delta_y = brisk.calculate_movement(last_frame, image)
-                horizontal_displacements.append(delta_x)
-                vertical_displacements.append(delta_y)
-
-                fullscreen_same_color(image)
-
-                last_frame = image
-                last_embedding = embedding
-                logging.debug('Parsing image: #{:04d}'.format(count))
-                count += 1
+            motion = motion_estimator(self.__motion)
+            solid_color = SolidColor()
+            frame_hash = FrameHash()
+            embed_seconds = 0.0
+            last_embedding = None
+
+            def embed(frames: List[np.ndarray]) -> List[np.ndarray]:
+                nonlocal embed_seconds, last_embedding
+                repeats = [frame_hash.is_repeat(frame) for frame in frames]
+                unique = [f for f, repeat in zip(frames, repeats) if not repeat]
+                if unique:
+                    embed_start = time.perf_counter()
+                    unique = iter(self.facenet.get_embedding(
+                        np.array(unique), batched=True)[:, None])
+                    embed_seconds += time.perf_counter() - embed_start
+                embeddings = []
+                for repeat in repeats:
+                    # repeated frames reuse the embedding of their run
+                    if not repeat:
+                        last_embedding = next(unique)
+                    embeddings.append(last_embedding)
+                return embeddings
+
+            def move(frames: List[np.ndarray]) -> List[tuple]:
+                movements = map(motion.update, frames)
+                return [m for m in movements if m is not None]
+
+            embeddings, movements, solid_flags = Pipeline(
+                Stage("embedding", embed, batch_size=self.__embed_batch_size,
+                      queue_size=self.__queue_size),
+                Stage("movement", move, queue_size=self.__queue_size),
+                Stage("solid_color",
+                      lambda frames: solid_color.detect(frames)[0],
+                      batch_size=self.__embed_batch_size,
+                      queue_size=self.__queue_size),
+            ).run(self.__frames())
 
             embeddings = np.array(embeddings)
-            similarities = np.array(similarities)
-            similarity_baseline = np.mean(similarities)
-
-            suspects = []
-            for i in range(similarities.shape[0]):
-                if similarities[i] < similarity_baseline:
-                    suspects.append(i)
-            suspects = np.array(suspects)
-            horizontal_displacements = np.array(horizontal_displacements)
-            vertical_displacements = np.array(vertical_displacements)
-
-            if self.__enable_cache:
-                np.savez(cache_data_path, embeddings, suspects,
-                         horizontal_displacements, vertical_displacements)
-                logging.debug("Cache save at: {} with size = {} bytes".format(
-                    cache_data_path,
-                    os.path.getsize(cache_data_path)
-                ))
+            solid_flags = np.array(solid_flags, dtype=bool)
+            frame_hash.report(self.__video_path, embed_seconds)
+            horizontal_displacements = np.array(
+                [delta_x for delta_x, _ in movements])
+            vertical_displacements = np.array(
+                [delta_y for _, delta_y in movements])
+            similarities = lagged_distances(embeddings, lags=(1,))[0]
+            suspects = np.flatnonzero(similarities < np.mean(similarities))
+
+            if self.__feature_cache is not None:
+                self.__feature_cache.save(
+                    cache_key,
+                    embeddings=embeddings,
+                    suspects=suspects,
+                    horizontal_displacements=horizontal_displacements,
+                    vertical_displacements=vertical_displacements,
+                    solid_flags=solid_flags
+                )
 
             gc.collect()
             logging.info("Delete frames and free the memory")
@@ -154,10 +220,15 @@ class Features:
             embeddings,
             suspects,
             horizontal_displacements,
-            vertical_displacements
+            vertical_displacements,
+            solid_flags
         ])
 
-    def feature_extraction(self) -> None:
+    def feature_extraction(
+        self,
+        window_sizes: Sequence[int] = range(2, 11),
+        dtype: np.dtype = None
+    ) -> None:
 
         start_time = time.perf_counter()
 
@@ -165,25 +236,18 @@ class Features:
         logging.info("Video path: {}, cache directory: {}".format(
             self.__video_path, self.__cache_dir))
 
-        embeddings, suspects, \
-            horizontal_displacements, vertical_displacements = self.__extract()
+        embeddings, suspects, horizontal_displacements, \
+            vertical_displacements, solid_flags = self.__extract()
 
         logging.info("Start testing similarity ...")
 
-        similarities = []
-        window_size_max = 10
-        for window_size in range(2, window_size_max + 1):
-            compare_with_next = window_size - 1
-            similarity = []
-            for emb1, emb2 in zip(
-                    embeddings[:-(1+window_size_max)],
-                    embeddings[
-                        compare_with_next:
-                        -(1+window_size_max-compare_with_next)
-                    ]):
-                similarity.append(euclidean_distance(emb1, emb2))
-            similarities.append(similarity)
-        similarities = np.array(similarities)
+        # a window of size w compares each frame with the (w - 1)-th next one
+        similarities = lagged_distances(
+            embeddings,
+            lags=np.asarray(window_sizes) - 1,
+            length=len(embeddings) - 1 - max(window_sizes),
+            dtype=dtype
+        )
 
         end_time = time.perf_counter()
         logging.info("Execution takes {} second(s).".format(
@@ -195,4 +259,5 @@ class Features:
         self.suspects = suspects
         self.horizontal_displacements = horizontal_displacements
         self.vertical_displacements = vertical_displacements
+        self.solid_flags = solid_flags
 
@@ -2,7 +2,7 @@ import cv2
 import logging
 import numpy as np
 
-from typing import List
+from typing import List, Optional
 
 
 class Brisk:
@@ -13,6 +13,7 @@ class Brisk:
         self.BFMatcher = cv2.BFMatcher(
             normType=cv2.NORM_HAMMING, crossCheck=True)
         self.__target_shape = (228, 228)
+        self.reset()
 
     def __dump_image(self, img1: np.ndarray, img2: np.ndarray, keypoints1: List[cv2.KeyPoint],
                      keypoints2: List[cv2.KeyPoint], matches: List[cv2.DMatch], dump_img_path: str) -> None:
@@ -26,19 +27,25 @@ class Brisk:
                                  flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS)
         cv2.imwrite(dump_img_path, output)
 
-    def calculate_movement(self, image1: np.ndarray, image2: np.ndarray, dump_img_path=None) -> tuple:
-
-        image1 = cv2.resize(image1, self.__target_shape,
-                            interpolation=cv2.INTER_AREA)
-        image2 = cv2.resize(image2, self.__target_shape,
-                            interpolation=cv2.INTER_AREA)
+    def reset(self) -> None:
+        self.__previous = None
 
+    def __detect(self, image: np.ndarray) -> tuple:
+        image = cv2.resize(image, self.__target_shape,
+                           interpolation=cv2.INTER_AREA)
         try:
-            keypoints1, descriptors1 = self.BRISK.detectAndCompute(
-                image1, None)
-            keypoints2, descriptors2 = self.BRISK.detectAndCompute(
-                image2, None)
+            keypoints, descriptors = self.BRISK.detectAndCompute(image, None)
+        except:
+            keypoints, descriptors = (), None
+        points = np.array([keypoint.pt for keypoint in keypoints],
+                          dtype=np.float64).reshape(-1, 2)
+        return image, keypoints, descriptors, points
+
+    def __displacement(self, previous: tuple, current: tuple, dump_img_path=None) -> tuple:
+        image1, keypoints1, descriptors1, points1 = previous
+        image2, keypoints2, descriptors2, points2 = current
 
+        try:
             matches = self.BFMatcher.match(queryDescriptors=descriptors1,
                                            trainDescriptors=descriptors2)
 
@@ -46,10 +53,12 @@ class Brisk:
                 self.__dump_image(image1, image2, keypoints1,
                                   keypoints2, matches, dump_img_path)
 
-            delta_x = np.mean([keypoints2[p.trainIdx].pt[0] -
-                               keypoints1[p.queryIdx].pt[0] for p in matches])
-            delta_y = np.mean([keypoints2[p.trainIdx].pt[1] -
-                               keypoints1[p.queryIdx].pt[1] for p in matches])
+            query_idx = np.fromiter((p.queryIdx for p in matches),
+                                    dtype=np.intp, count=len(matches))
+            train_idx = np.fromiter((p.trainIdx for p in matches),
+                                    dtype=np.intp, count=len(matches))
+            delta_x, delta_y = np.mean(
+                points2[train_idx] - points1[query_idx], axis=0)
 
         except:
             # if shape error, value error, or else
@@ -63,3 +72,17 @@ class Brisk:
             delta_x, delta_y))
 
         return (delta_x, delta_y)
+
+    def calculate_movement(self, image1: np.ndarray, image2: np.ndarray, dump_img_path=None) -> tuple:
+        return self.__displacement(self.__detect(image1), self.__detect(image2), dump_img_path)
+
+    def update(self, image: np.ndarray, dump_img_path=None) -> Optional[tuple]:
+        """ Streaming version of calculate_movement, the keypoints of the
+            previous frame are reused so each frame is detected only once.
+            Returns None for the first frame of the stream.
+        """
+        current = self.__detect(image)
+        previous, self.__previous = self.__previous, current
+        if previous is None:
+            return None
+        return self.__displacement(previous, current, dump_img_path)
@@ -0,0 +1,147 @@
+import os
+import av
+import cv2
+import time
+import logging
+import tempfile
+import numpy as np
+
+from typing import Iterator, Optional
+from av.sidedata.sidedata import Type
+
+from preprocessing.movement.brisk import Brisk
+
+
+class MotionVectors:
+    """Global motion from the motion vectors the H.264 decoder exports
+
+    No optical flow or keypoint matching is done and the decoded pictures are
+    never converted to arrays. Every frame is summarized as the median
+    (dx, dy) of its macroblock vectors, in pixels of the (228, 228) frame
+    that Brisk works on, and the fraction of the frame covered by moving
+    macroblocks. Intra frames carry no vectors and are reported as still.
+
+    Vectors are relative to the reference picture, which is the previous
+    frame for the I/P-only streams of screen recordings. With B-frames the
+    reference may be several frames away, so the displacement is that many
+    frames of motion, and vectors to a future reference are negated.
+
+    Args:
+        min_motion (:obj:`float`, optional): Displacement in source pixels
+            above which a macroblock counts as moving. Defaults to 0.5.
+
+    """
+
+    def __init__(self, min_motion: float = 0.5) -> None:
+        self.__min_motion = min_motion
+        self.__target_shape = (228, 228)
+
+    def summarize(self, vectors: Optional[np.ndarray], width: int, height: int) -> tuple:
+        """ (dx, dy, moving ratio) of one frame from its exported vectors
+        """
+        if vectors is None or not len(vectors):
+            return (0.0, 0.0, 0.0)
+
+        # motion_x / motion_scale is src - dst, i.e. the opposite of the
+        # content displacement from a past reference
+        direction = np.sign(vectors["source"]).astype(np.float64)
+        scale = vectors["motion_scale"].astype(np.float64)
+        displacement = np.stack([
+            vectors["motion_x"] * direction / scale,
+            vectors["motion_y"] * direction / scale,
+        ], axis=1)
+
+        delta_x, delta_y = np.median(displacement, axis=0) * \
+            (np.array(self.__target_shape) / (width, height))
+
+        moving = np.abs(displacement).max(axis=1) > self.__min_motion
+        area = vectors["w"].astype(np.int64) * vectors["h"]
+        moving_ratio = min(float(area[moving].sum()) / (width * height), 1.0)
+
+        logging.debug("Movement between two images is: ({}, {})".format(
+            delta_x, delta_y))
+
+        return (float(delta_x), float(delta_y), moving_ratio)
+
+    def frames(self, video_path: str) -> Iterator[tuple]:
+        """ Yield (dx, dy, moving ratio) of every frame in presentation order
+        """
+        container = av.open(video_path)
+        try:
+            stream = container.streams.video[0]
+            stream.thread_type = "AUTO"
+            stream.codec_context.options = {"flags2": "+export_mvs"}
+            for frame in container.decode(stream):
+                vectors = None
+                for data in frame.side_data:
+                    if data.type == Type.MOTION_VECTORS:
+                        vectors = data.to_ndarray()
+                yield self.summarize(vectors, frame.width, frame.height)
+        finally:
+            container.close()
+
+    def extract(self, video_path: str) -> np.ndarray:
+        """ (#frames, 3) array of (dx, dy, moving ratio), the first row is
+            the first frame compared with nothing
+        """
+        return np.array(list(self.frames(video_path)), dtype=np.float64).reshape(-1, 3)
+
+
+def benchmark(video_path: str = None, n_frames: int = 150, shift: int = 4) -> None:
+    """ Per-frame speed of the motion vectors against decoding + Brisk, and
+        their agreement. Without a video a scrolling screen-like clip is
+        encoded first, without B-frames like the screen recorder.
+    """
+    if video_path is None:
+        rng = np.random.default_rng(0)
+        texture = np.kron(rng.integers(0, 255, (60, 30, 3), dtype=np.uint8),
+                          np.ones((12, 12, 1), dtype=np.uint8))
+        video_path = os.path.join(tempfile.mkdtemp(), "scroll.mp4")
+        container = av.open(video_path, "w")
+        stream = container.add_stream("libx264", rate=30, options={"bf": "0"})
+        stream.width, stream.height, stream.pix_fmt = 360, 720, "yuv420p"
+        for i in range(n_frames):
+            # still, scrolling down, then still again
+            offset = shift * min(max(i - n_frames // 3, 0), n_frames // 3)
+            frame = av.VideoFrame.from_ndarray(
+                np.roll(texture, offset, axis=0), format="rgb24")
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+        container.close()
+
+    start = time.perf_counter()
+    vectors = MotionVectors().extract(video_path)
+    mv_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    brisk = Brisk()
+    movements = [(0.0, 0.0)]
+    vidcap = cv2.VideoCapture(video_path)
+    success, image = vidcap.read()
+    while success:
+        movement = brisk.update(image)
+        if movement is not None:
+            movements.append(movement)
+        success, image = vidcap.read()
+    vidcap.release()
+    brisk_seconds = time.perf_counter() - start
+
+    length = min(len(vectors), len(movements))
+    difference = np.abs(vectors[:length, :2] -
+                        np.array(movements[:length])).mean(axis=0)
+    print("{:>14} {:>10.1f} frames/s".format(
+        "motion vectors", len(vectors) / mv_seconds))
+    print("{:>14} {:>10.1f} frames/s".format(
+        "decode + brisk", len(movements) / brisk_seconds))
+    print("mean |dx|, |dy| difference: {:.3f}, {:.3f} (228 px units)".format(
+        *difference))
+
+
+if __name__ == "__main__":
+    """
+    python3 -m preprocessing.movement.motion_vectors [video]
+    """
+    import sys
+    benchmark(*sys.argv[1:2])
@@ -15,44 +15,68 @@ class Pixel:
         logging.info("Initializing preprocessing.partion.pixel")
         pass
 
-    def __warpMask(
-        self,
-        image: np.ndarray,
-        mask: np.ndarray,
-        p: int,
-        q: int,
+    @staticmethod
+    def __block_scores(
+        images1: np.ndarray,
+        images2: np.ndarray,
+        scale: tuple
+    ) -> np.ndarray:
+        """ L2 norm of the difference of every (scale[0], scale[1]) block,
+            shape (..., h // scale[0], w // scale[1])
+        """
+        *batch, h, w, c = images1.shape
+        difference = (images1 - images2).astype(
+            np.promote_types(images1.dtype, np.int32))
+        return np.sqrt(np.square(difference).reshape(
+            *batch,
+            h // scale[0],
+            scale[0],
+            w // scale[1],
+            scale[1],
+            c
+        ).sum(axis=(-4, -2, -1)))
+
+    @staticmethod
+    def __warp_masks(
+        images: np.ndarray,
+        masks: np.ndarray,
         scale: tuple
     ) -> None:
-        if mask > 0:
-            index = 1  # red, large distance
-            image[
-                p * scale[0]: (p + 1) * scale[0],
-                q * scale[1]: (q + 1) * scale[1],
-                index
-            ] = np.clip(
-                image[
-                    p * scale[0]: (p + 1) * scale[0],
-                    q * scale[1]: (q + 1) * scale[1],
-                    index
-                ].astype(float) * mask,
-                0.0,
-                255.0
-            ).astype("uint8")
-        elif mask < 0:
-            index = 2  # blue, small distance
-            image[
-                p * scale[0]: (p + 1) * scale[0],
-                q * scale[1]: (q + 1) * scale[1],
-                index
-            ] = np.clip(
-                image[
-                    p * scale[0]: (p + 1) * scale[0],
-                    q * scale[1]: (q + 1) * scale[1],
-                    index
-                ].astype(float) * (-mask),
-                0.0,
-                255.0
-            ).astype("uint8")
+        pixel_masks = np.repeat(
+            np.repeat(masks, scale[0], axis=-2),
+            scale[1],
+            axis=-1
+        )
+        # red for large distance, blue for small distance
+        for index, weights in ((1, pixel_masks), (2, -pixel_masks)):
+            channel = images[..., index]
+            images[..., index] = np.where(
+                weights > 0,
+                np.clip(channel.astype(float) * weights, 0.0, 255.0),
+                channel
+            )
+
+    def get_heatmaps(
+        self,
+        images1: np.ndarray,
+        images2: np.ndarray,
+        scale: tuple = (5, 5)
+    ) -> np.ndarray:
+        """ Overlay the block-wise difference heatmap on images1 in place,
+            images1 and images2 are (h, w, 3) frames or (n, h, w, 3) batches
+        """
+        assert np.all(images1.shape == images2.shape), \
+            "shape of two images should be same"
+
+        scores = self.__block_scores(images1, images2, scale)
+        nonzero = scores != 0.0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            baseline = (scores * nonzero).sum(axis=(-2, -1), keepdims=True) / \
+                nonzero.sum(axis=(-2, -1), keepdims=True)
+            map_mask = (scores - baseline) / baseline * nonzero
+
+        self.__warp_masks(images1, map_mask, scale)
+        return images1
 
     def get_heatmap(
         self,
@@ -69,38 +93,7 @@ class Pixel:
 
         logging.info("Start getting pixel-wise differences map.")
 
-        h, w, __ = image1.shape
-        splitted_image1 = image1.reshape(
-            h // scale[0],
-            scale[0],
-            -1,
-            scale[1],
-            3
-        ).swapaxes(1, 2).reshape(
-            (h // scale[0]) * (w // scale[1]),
-            -1
-        )
-        splitted_image2 = image2.reshape(
-            h // scale[0],
-            scale[0],
-            -1,
-            scale[1],
-            3
-        ).swapaxes(1, 2).reshape(
-            (h // scale[0]) * (w // scale[1]),
-            -1
-        )
-
-        scores = norm(
-            splitted_image1 - splitted_image2,
-            axis=1
-        ).reshape(h // scale[0], w // scale[1])
-        baseline = np.mean(scores[scores != 0.0])
-
-        map_mask = (scores - baseline) / baseline * scores.astype(bool)
-        for p in range(int(image1.shape[0] / scale[0])):  # y
-            for q in range(int(image1.shape[1] / scale[1])):  # x
-                self.__warpMask(image1, map_mask[p][q], p, q, scale)
+        self.get_heatmaps(image1, image2, scale)
 
         if output:
             image_paths = (
@@ -123,3 +116,54 @@ class Pixel:
 
         return image1
 
+
+def test_heatmap(shape: tuple = (360, 360, 3), scale: tuple = (5, 5), batch: int = 16) -> None:
+    """ Compare with the per-block loop the heatmap used to be and report the speedup
+    """
+    def reference(image1: np.ndarray, image2: np.ndarray) -> np.ndarray:
+        h, w, __ = image1.shape
+        blocks1 = image1.reshape(h // scale[0], scale[0], -1, scale[1], 3).swapaxes(
+            1, 2).reshape((h // scale[0]) * (w // scale[1]), -1)
+        blocks2 = image2.reshape(h // scale[0], scale[0], -1, scale[1], 3).swapaxes(
+            1, 2).reshape((h // scale[0]) * (w // scale[1]), -1)
+        scores = norm(blocks1 - blocks2, axis=1).reshape(h // scale[0], w // scale[1])
+        baseline = np.mean(scores[scores != 0.0])
+        map_mask = (scores - baseline) / baseline * scores.astype(bool)
+        for p in range(h // scale[0]):
+            for q in range(w // scale[1]):
+                for index, mask in ((1, map_mask[p][q]), (2, -map_mask[p][q])):
+                    if mask > 0:
+                        block = image1[p * scale[0]: (p + 1) * scale[0],
+                                       q * scale[1]: (q + 1) * scale[1], index]
+                        block[:] = np.clip(block.astype(float) * mask,
+                                           0.0, 255.0).astype("uint8")
+        return image1
+
+    rng = np.random.default_rng(0)
+    images1 = rng.integers(0, 255, (batch,) + shape, dtype=np.uint8)
+    images2 = rng.integers(0, 255, (batch,) + shape, dtype=np.uint8)
+    images2[:, :shape[0] // 2] = images1[:, :shape[0] // 2]
+    pixel = Pixel()
+
+    start = time.perf_counter()
+    expected = np.array([reference(i1, i2) for i1, i2 in zip(images1.copy(), images2)])
+    reference_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    single = np.array([pixel.get_heatmap(i1, i2, scale) for i1, i2 in zip(images1.copy(), images2)])
+    single_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = pixel.get_heatmaps(images1.copy(), images2, scale)
+    batched_seconds = time.perf_counter() - start
+
+    assert np.array_equal(expected, single) and np.array_equal(expected, batched)
+    print("loop {:.3f}s, vectorized {:.3f}s ({:.1f}x), batched {:.3f}s ({:.1f}x)".format(
+        reference_seconds,
+        single_seconds, reference_seconds / single_seconds,
+        batched_seconds, reference_seconds / batched_seconds
+    ))
+
+
+if __name__ == "__main__":
+    test_heatmap()
@@ -0,0 +1,112 @@
+import time
+import queue
+import logging
+import threading
+import numpy as np
+
+from typing import Callable, Iterable, List
+
+
+_END = object()
+
+
+class Stage(threading.Thread):
+    """Worker that applies a batched function to the frames of a stream
+
+    Args:
+        name (:obj:`str`): Stage name used in the utilization log.
+        fn (:obj:`Callable`): Takes a list of frames and returns a list of
+            results. Batches arrive in frame order, so stateful functions
+            (e.g. comparing with the previous frame) are allowed.
+        batch_size (:obj:`int`, optional): Max #frames per call. Defaults to 1.
+        queue_size (:obj:`int`, optional): Capacity of the input queue, which
+            bounds the frames held in memory. Defaults to 64.
+
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[List[np.ndarray]], list],
+        batch_size: int = 1,
+        queue_size: int = 64
+    ) -> None:
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.batch_size = batch_size
+        self.inbox = queue.Queue(maxsize=queue_size)
+        self.results = []
+        self.busy_seconds = 0.0
+        self.error = None
+
+    def __flush(self, batch: List[np.ndarray]) -> None:
+        if not batch or self.error is not None:
+            return
+        start = time.perf_counter()
+        try:
+            self.results.extend(self.fn(batch))
+        except Exception as e:
+            # keep draining the queue so that the producer never blocks
+            logging.debug("{} stage failed: {}".format(self.name, repr(e)))
+            self.error = e
+        self.busy_seconds += time.perf_counter() - start
+
+    def run(self) -> None:
+        batch = []
+        while True:
+            item = self.inbox.get()
+            if item is _END:
+                self.__flush(batch)
+                return
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                self.__flush(batch)
+                batch = []
+
+
+class Pipeline:
+    """Fans decoded frames out to parallel stages and joins their results
+
+    Every stage sees every frame in order and its results are returned in
+    that order. The decoding iterator runs on the calling thread.
+
+    """
+
+    def __init__(self, *stages: Stage) -> None:
+        self.stages = stages
+
+    def run(self, frames: Iterable[np.ndarray]) -> List[list]:
+        start_time = time.perf_counter()
+        for stage in self.stages:
+            stage.start()
+
+        decode_seconds, count = 0.0, 0
+        frames = iter(frames)
+        while True:
+            decode_start = time.perf_counter()
+            frame = next(frames, _END)
+            decode_seconds += time.perf_counter() - decode_start
+            for stage in self.stages:
+                stage.inbox.put(frame)
+            if frame is _END:
+                break
+            count += 1
+
+        for stage in self.stages:
+            stage.join()
+
+        wall_seconds = time.perf_counter() - start_time
+        logging.info("Pipeline: {} frames in {:.2f} second(s)".format(
+            count, wall_seconds))
+        logging.info("Stage utilization: decode {:.1%}, {}".format(
+            decode_seconds / wall_seconds,
+            ", ".join(
+                "{} {:.1%}".format(stage.name, stage.busy_seconds / wall_seconds)
+                for stage in self.stages
+            )
+        ))
+
+        for stage in self.stages:
+            if stage.error is not None:
+                raise stage.error
+        return [stage.results for stage in self.stages]
@@ -1,18 +1,36 @@
 import cv2
 import time
 import logging
-import itertools
 import numpy as np
-from typing import List, Union
-
-from util.utils import euclidean_distance
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 
 
 class Affine:
+    """Searching the affine transformation that maps image1 closest to image2
+
+    Every transformation family is searched coarse-to-fine on an image
+    pyramid: the whole grid of candidates is tried on the smallest level,
+    then only the neighbourhood of the best one on each finer level.
+
+    Args:
+        levels (:obj:`int`, optional): #downsamplings of the pyramid.
+            Defaults to 2.
+        max_workers (:obj:`int`, optional): Families searched in parallel.
+            Defaults to 3.
 
-    def __init__(self) -> None:
+    """
+
+    def __init__(self, levels: int = 2, max_workers: int = 3) -> None:
         logging.info("Initializing preprocessing.transformation.affine")
-        pass
+        self.__levels = levels
+        self.__max_workers = max_workers
+        # (matrix function, coarse grid of value1, fixed value2, refinement step)
+        self.__families = dict({
+            "rotate": (self.__rotate, np.arange(-5.0, 6.0), 1.0, 0.5),
+            "scale": (self.__scale, np.arange(0.9, 1.11, 0.02), 1.0, 0.01),
+            "shear": (self.__shear, np.arange(-0.1, 0.11, 0.02), 0.0, 0.01),
+        })
 
     def __scale(self, shape, x: float = 1.1, y: float = 1.0) -> np.array:
         return np.array([[x, 0.0, 0.0], [0.0, y, 0.0]])
@@ -23,21 +41,54 @@ class Affine:
     def __shear(self, shape, x: float = 0.1, y: float = 0.0) -> np.array:
         return np.array([[1.0, x, -0.5 * x * shape[0]], [y, 1.0, -0.5 * y * shape[1]]])
 
-    def __transformation_trial(self, mask, anchor_embedding, transformation_func, image1, image2_border) -> List[Union[int, float]]:
+    def __matrix(self, family: str, shape: tuple, value1: float, value2: float) -> np.array:
+        return self.__families[family][0](shape, value1, value2)
+
+    def __pyramid(self, image1: np.array, image2: np.array) -> List[tuple]:
+        pyramid = []
+        for level in range(self.__levels + 1):
+            if level:
+                image1, image2 = cv2.pyrDown(image1), cv2.pyrDown(image2)
+            # get the background mask
+            # this is neccessary otherwise transformation results might exceed border
+            background_mask = (image2 == image2[0][0]).astype(
+                int) * (255 if image2[0][0][0] else -255)
+            pyramid.append((
+                image1,
+                image2.astype(np.float32),
+                background_mask,
+                tuple(image2[0][0].tolist())
+            ))
+        return pyramid
+
+    @staticmethod
+    def __distance(image1, image2, mask, border_value, matrix) -> float:
+        transformed = cv2.warpAffine(
+            image1, matrix, image1.shape[1::-1], borderValue=border_value)
+        transformed = np.clip(transformed + mask, 0, 255).astype(np.float32)
+        return float(np.linalg.norm(transformed - image2))
+
+    def __transformation_trial(self, family: str, pyramid: List[tuple]) -> Tuple[tuple, float]:
         s = time.perf_counter()
-        value1_range = np.arange(-5, 6)
-        value2_range = np.arange(1, 2)
-        iter_list = list(itertools.product(value1_range, value2_range))
-        logging.debug("Testing: {}, {}".format(value1_range, value2_range))
-        transforms = []
-        for value1, value2 in iter_list:
-            transforms.append(cv2.warpAffine(image1, transformation_func(
-                image1.shape, value1, value2), image1.shape[1::-1], borderValue=image2_border))
-        transforms = np.reshape(np.clip(
-            transforms + mask, 0, 255).astype("uint8"), (-1, image1.shape[0] * image1.shape[1] * 3))
-        distances = np.linalg.norm(transforms - anchor_embedding, axis=1)
-        logging.debug("takes {} s".format(time.perf_counter() - s))
-        return iter_list, distances
+        _, value1_range, value2, step = self.__families[family]
+        best = None
+        for image1, image2, mask, border_value in reversed(pyramid):
+            if best is None:
+                candidates = value1_range
+            else:
+                candidates = best + step * np.arange(-2, 3)
+                step /= 2
+            candidates = np.round(candidates, 6)
+            # candidates are warped one at a time instead of being stacked
+            distances = [
+                self.__distance(image1, image2, mask, border_value,
+                                self.__matrix(family, image1.shape, value1, value2))
+                for value1 in candidates
+            ]
+            best = candidates[np.argmin(distances)]
+        logging.debug("{}: {} takes {} s".format(
+            family, best, time.perf_counter() - s))
+        return (float(best), value2), min(distances)
 
     def compare_transformation(self, image1: np.array, image2: np.array) -> dict:
         """
@@ -47,23 +98,22 @@ class Affine:
 
         logging.info("Comparing every transformation")
 
-        anchor_embedding = np.reshape(
-            image2, (image2.shape[0] * image2.shape[1] * 3))
-
-        # get the background mask
-        # this is neccessary otherwise transformation results might exceed border
-        background_mask = (image2 == image2[0][0]).astype(
-            int) * (255 if image2[0][0][0] else -255)
-        # y, x, _ = np.where(image2 != image2[0][0])
-        # index_mask = np.array([np.min(x), np.min(y), np.max(x), np.max(y)])
-
         x, y, _ = np.where(image2 != image2[0][0])
-        if np.all(image2[np.min(x)][np.min(y)] == image2[np.max(x)][np.max(y)]):
-            border_value = image2[np.min(x)][np.min(y)]
-            keys, values = self.__transformation_trial(
-                background_mask, anchor_embedding, self.__rotate, image1, tuple(image2[0][0].tolist()))
-        else:
+        if not np.all(image2[np.min(x)][np.min(y)] == image2[np.max(x)][np.max(y)]):
             return dict({"none": None})
 
+        pyramid = self.__pyramid(image1, image2)
+        with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+            results = dict(zip(
+                self.__families,
+                executor.map(
+                    lambda family: self.__transformation_trial(
+                        family, pyramid),
+                    self.__families
+                )
+            ))
+
         logging.info("ok")
-        return dict({"rotate": keys[np.argmin(values)]})
+        return dict({
+            family: values for family, (values, _) in results.items()
+        })
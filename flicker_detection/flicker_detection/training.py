@@ -1,7 +1,9 @@
 import os
 import json
 import gc
+import time
 import logging
+import contextlib
 import tqdm
 import torch
 import numpy as np
@@ -11,10 +13,81 @@ from typing import Callable, Tuple
 
 from argparse import ArgumentParser
 from mypyfunc.logger import init_logger
-from mypyfunc.torch_eval import F1Score, Evaluation
+from mypyfunc.torch_eval import F1Score, ConfusionMatrix, Evaluation
 from mypyfunc.torch_models import CNN_LSTM,CNN_Transformers,OHEMLoss
-from mypyfunc.torch_utility import save_checkpoint, save_metrics, load_checkpoint, load_metrics, torch_seeding
+from mypyfunc.torch_utility import save_checkpoint, save_metrics, load_metrics, torch_seeding
+from mypyfunc.torch_utility import autocast, grad_scaler, reset_peak_memory, peak_memory, saved_activations
+from mypyfunc.torch_utility import init_distributed, is_main_process, reduce_mean
+from mypyfunc.torch_utility import CheckpointWriter, training_state, restore_training_state
 from mypyfunc.streamer import MultiStreamer, VideoDataSet
+from mypyfunc.feature_store import FeatureStore, FeatureStreamer
+from mypyfunc.backbones import BACKBONES, Backbone, feature_dim
+
+
+def model_inputs(inputs: torch.Tensor) -> torch.Tensor:
+    """ (batch, chunk, channels, height, width) float inputs from video
+        chunks, stored (batch, chunk, features) inputs are passed through
+    """
+    if inputs.dim() == 5:
+        inputs = inputs.permute(0, 1, 4, 2, 3)
+    return inputs.float()
+
+
+def accumulate_gradients(
+    model: nn.Module,
+    inputs: torch.Tensor,
+    labels: torch.Tensor,
+    criterion: Callable,
+    epoch: int,
+    scaler: torch.cuda.amp.GradScaler,
+    amp: bool = False,
+    micro_batch_size: int = 0,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """ Forward and backward passes of one batch, `micro_batch_size` windows
+        at a time, into the gradients of the whole batch. From its init_epoch
+        on, OHEMLoss first ranks the whole batch without gradients and only
+        its hardest windows are back-propagated, so that the kept windows are
+        the hardest of the batch and not of every micro-batch.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: Detached outputs of the whole batch
+        and its loss
+
+    """
+    distributed = isinstance(model, nn.parallel.DistributedDataParallel)
+    micro_size = micro_batch_size or len(labels)
+    outputs, kept_inputs, kept_labels = None, inputs, labels
+    if micro_size < len(labels) and isinstance(criterion, OHEMLoss) \
+            and epoch >= criterion.init_epoch:
+        # no gradients to synchronize, nor graphs to keep
+        ranking_model = model.module if distributed else model
+        with torch.no_grad(), autocast(inputs.device, enabled=amp):
+            outputs = torch.cat([
+                ranking_model(micro_inputs).float()
+                for micro_inputs in inputs.split(micro_size)
+            ])
+        keep_idx = criterion.hard_examples(outputs, labels)
+        kept_inputs, kept_labels = inputs[keep_idx], labels[keep_idx]
+
+    micro_outputs_all, loss = (), 0
+    micro_batches = list(zip(kept_inputs.split(micro_size), kept_labels.split(micro_size)))
+    for n_micro, (micro_inputs, micro_labels) in enumerate(micro_batches, start=1):
+        # gradients are all-reduced once, after the last micro-batch
+        with model.no_sync() if distributed and n_micro < len(micro_batches) \
+                else contextlib.nullcontext():
+            with autocast(inputs.device, enabled=amp):
+                micro_outputs = model(micro_inputs).float()
+                if outputs is None:
+                    # mean over the batch, not over each micro-batch
+                    micro_loss = criterion(micro_outputs, micro_labels, epoch) * \
+                        (len(micro_labels) / len(labels))
+                else:
+                    micro_loss = criterion.kept_loss(
+                        micro_outputs, micro_labels, len(kept_labels))
+            scaler.scale(micro_loss).backward()
+        micro_outputs_all += (micro_outputs.detach(),)
+        loss += micro_loss.detach()
+    return torch.cat(micro_outputs_all) if outputs is None else outputs, loss
 
 
 def training(
@@ -23,79 +96,120 @@ def training(
     model: nn.Module,
     optimizer: torch.optim.Optimizer,
     scheduler: torch.optim,
-    f1_metric: Callable,
+    f1_metric: ConfusionMatrix,
     criterion: Callable,
     objective: Callable,
     epochs: int,
     device: torch.device,
     save_path: str,
+    amp: bool = False,
+    micro_batch_size: int = 0,
+    resume: bool = False,
 ) -> nn.Module:
-    val_max_f1 = 0
+    """ `micro_batch_size` splits every batch for the forward and backward
+        passes and accumulates the gradients into one optimizer step, so the
+        activation memory only depends on the micro-batch, 0 disables it.
+        The full training state is written to `save_path`/last.pth after
+        every epoch, in the background, and `resume` continues from it.
+    """
+    val_max_f1, start_epoch = 0, 0
+    scaler = grad_scaler(device, enabled=amp)
+    distributed = isinstance(model, nn.parallel.DistributedDataParallel)
+    writer = CheckpointWriter() if is_main_process() else None
     f1_callback, loss_callback, val_f1_callback, val_loss_callback = (), (), (), ()
-    for epoch in range(epochs):
+    last_path = os.path.join(save_path, 'last.pth')
+    if resume and os.path.exists(last_path):
+        start_epoch, callbacks, val_max_f1 = restore_training_state(
+            last_path, model, optimizer, scheduler, scaler, map_location=device)
+        f1_callback, loss_callback, val_f1_callback, val_loss_callback = callbacks
+        logging.info("Resuming from epoch {}/{}".format(start_epoch + 1, epochs))
+
+    for epoch in range(start_epoch, epochs):
         if loss_callback and epoch > 11 and loss_callback[-1] < 0.05:
             break
 
         model.train()
-        minibatch_loss_train, minibatch_f1 = 0, 0
-        for n_train, (inputs, labels) in enumerate(tqdm.tqdm(train_loader)):
-            inputs = inputs.permute(
-                0, 1, 4, 2, 3).float().to(f'cuda:{model.device_ids[0]}')
-            labels = labels.long().to(f'cuda:{model.device_ids[0]}')
-            outputs = model(inputs)
-            loss = criterion(outputs, labels,epoch)
-            optimizer.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm(model.parameters(), 1.0)
-            optimizer.step()
-
-            f1 = f1_metric(torch.topk(objective(outputs),
-                                      k=1, dim=1).indices.flatten(), labels)
-            minibatch_loss_train += loss.item()
-            minibatch_f1 += f1.item()
+        # accumulated on the device, read once per epoch
+        minibatch_loss_train, n_train = torch.zeros((), device=device), 0
+        f1_metric.reset()
+        # ranks may run out of batches at different steps
+        with model.join() if distributed else contextlib.nullcontext():
+            for n_train, (inputs, labels) in enumerate(
+                    tqdm.tqdm(train_loader, disable=not is_main_process()), start=1):
+                inputs = model_inputs(inputs).to(device)
+                labels = labels.long().to(device)
+                optimizer.zero_grad()
+                outputs, loss = accumulate_gradients(
+                    model, inputs, labels, criterion, epoch, scaler,
+                    amp=amp, micro_batch_size=micro_batch_size)
+                # clip the true gradients, not the scaled ones
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+                scaler.step(optimizer)
+                scaler.update()
+
+                f1_metric.update(torch.topk(objective(outputs),
+                                            k=1, dim=1).indices.flatten(), labels)
+                minibatch_loss_train += loss
 
         model.eval()
-        loss_callback += ((minibatch_loss_train / (n_train + 1))
-                          if n_train else minibatch_loss_train,)
-        f1_callback += ((minibatch_f1/(n_train + 1))
-                        if n_train else minibatch_f1,)
+        # mean batch loss of every rank, F1 of the epoch over every rank
+        loss_callback += (reduce_mean(minibatch_loss_train, n_train, device),)
+        f1_callback += (f1_metric.all_reduce()(),)
         scheduler.step(loss_callback[-1])
         
+        # DDP keeps notifying the join context on every forward, evaluation
+        # needs no synchronization and ranks have different #batches
+        eval_model = model.module if distributed else model
         with torch.no_grad():
-            minibatch_loss_val, minibatch_f1_val = 0, 0
-            for n_val, (inputs, labels) in enumerate(tqdm.tqdm(val_loader)):
-                inputs = inputs.permute(
-                    0, 1, 4, 2, 3).float().to(f'cuda:{model.device_ids[0]}')
-                labels = labels.long().to(f'cuda:{model.device_ids[0]}')
-
-                outputs = model(inputs)
-                loss = criterion(outputs, labels,epoch)
-                val_f1 = f1_metric(
+            minibatch_loss_val, n_val = torch.zeros((), device=device), 0
+            f1_metric.reset()
+            for n_val, (inputs, labels) in enumerate(
+                    tqdm.tqdm(val_loader, disable=not is_main_process()), start=1):
+                inputs = model_inputs(inputs).to(device)
+                labels = labels.long().to(device)
+
+                outputs = ()
+                for micro_inputs in inputs.split(micro_batch_size or len(inputs)):
+                    with autocast(device, enabled=amp):
+                        outputs += (eval_model(micro_inputs).float(),)
+                outputs = torch.cat(outputs)
+                f1_metric.update(
                     torch.topk(objective(outputs), k=1, dim=1).indices.flatten(), labels)
-                minibatch_loss_val += loss.item()
-                minibatch_f1_val += val_f1.item()
-
-        val_loss_callback += ((minibatch_loss_val/(n_val + 1))
-                              if n_val else minibatch_loss_val,)
-        val_f1_callback += ((minibatch_f1_val/(n_val + 1))
-                            if n_val else minibatch_f1_val,)
-
-        logging.info(
-            "Epoch: {}/{} Loss - {:.3f},f1 - {:.3f} val_loss - {:.3f}, val_f1 - {:.3f}".format(
-                epoch + 1, epochs,
-                loss_callback[-1],
-                f1_callback[-1],
-                val_loss_callback[-1],
-                val_f1_callback[-1]
-            ))
-
+                # OHEM keeps the hardest windows of the whole batch
+                minibatch_loss_val += criterion(outputs, labels, epoch)
+
+        val_loss_callback += (reduce_mean(minibatch_loss_val, n_val, device),)
+        val_f1_callback += (f1_metric.all_reduce()(),)
+
+        if is_main_process():
+            logging.info(
+                "Epoch: {}/{} Loss - {:.3f},f1 - {:.3f} val_loss - {:.3f}, val_f1 - {:.3f}".format(
+                    epoch + 1, epochs,
+                    loss_callback[-1],
+                    f1_callback[-1],
+                    val_loss_callback[-1],
+                    val_f1_callback[-1]
+                ))
+
+        # every rank sees the same reduced val_f1, only the first one writes
         if epoch > 10 and val_f1_callback[-1] > val_max_f1:
-            save_checkpoint(f'{save_path}/model.pth', model,
-                            optimizer, loss_callback[-1], f1_callback[-1], val_loss_callback[-1], val_f1_callback[-1])
-            save_metrics(f'{save_path}/metrics.pth', loss_callback, f1_callback,
-                         val_loss_callback, val_f1_callback)
+            if is_main_process():
+                save_checkpoint(f'{save_path}/model.pth', model,
+                                optimizer, loss_callback[-1], f1_callback[-1], val_loss_callback[-1], val_f1_callback[-1],
+                                writer=writer)
+                save_metrics(f'{save_path}/metrics.pth', loss_callback, f1_callback,
+                             val_loss_callback, val_f1_callback, writer=writer)
             val_max_f1 = val_f1_callback[-1]
 
+        if writer is not None:
+            writer.save(last_path, training_state(
+                epoch, model, optimizer, scheduler, scaler,
+                (f1_callback, loss_callback, val_f1_callback, val_loss_callback),
+                val_max_f1))
+
+    if writer is not None:
+        writer.close()
     torch.cuda.empty_cache()
     return model
 
@@ -108,20 +222,24 @@ def testing(
     device: torch.device,
     classes: int,
     save_path: str,
+    amp: bool = False,
 ) -> None:
     logging.getLogger('matplotlib').setLevel(logging.WARNING)
     metrics = Evaluation(plots_folder="plots/", classes=classes)
     model.load_state_dict(torch.load(os.path.join(
-        save_path, 'model.pth'))['model_state_dict'])
+        save_path, 'model.pth'), map_location=device)['model_state_dict'])
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        # tested on one rank only
+        model = model.module
     model.eval()
     y_pred, y_true = (), () 
     with torch.no_grad():
         for (inputs, labels) in tqdm.tqdm(test_loader):
-            inputs = inputs.permute(
-                0, 1, 4, 2, 3).float().to(f'cuda:{model.device_ids[0]}')
-            labels = labels.long().to(f'cuda:{model.device_ids[0]}')
-            outputs = model(inputs)
-              
+            inputs = model_inputs(inputs).to(device)
+            labels = labels.long().to(device)
+            with autocast(device, enabled=amp):
+                outputs = model(inputs).float()
+
             y_pred += (objective(outputs),)
             y_true += (labels,)
 
@@ -148,6 +266,151 @@ def testing(
     metrics.report(y_true, y_classes)
 
 
+def test_amp(
+    device: torch.device = None,
+    steps: int = 60,
+    batch_size: int = 8,
+    image_size: int = 64,
+    tolerance: float = 0.05,
+) -> None:
+    """ Throughput, memory and validation F1 of the same CNN_LSTM trained with
+        and without AMP on synthetic windows, a flicker window has one bright
+        frame. Saved activations are counted on every device since the CPU
+        peak memory is the one of the whole process.
+    """
+    from torchvision.models.vgg import VGG, make_layers
+
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    generator = torch.Generator().manual_seed(0)
+
+    def windows(n: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        labels = torch.arange(n) % 2
+        inputs = torch.rand((n, 10, 3, image_size, image_size),
+                            generator=generator) * 0.2
+        flash = torch.randint(0, 10, (n,), generator=generator)
+        inputs[labels.bool(), flash[labels.bool()]] += 0.8
+        return inputs.to(device), labels.to(device)
+
+    train_set = [windows(batch_size) for _ in range(steps)]
+    val_inputs, val_labels = windows(64)
+    metric = F1Score(average='macro')
+
+    def run(amp: bool) -> Tuple[float, float, float, float]:
+        torch.manual_seed(12345)
+        model = CNN_LSTM(
+            cnn=VGG(make_layers([16, 'M', 32, 'M', 64, 'M'])),
+            input_dim=64 * 7 * 7,
+            output_dim=2,
+            hidden_dim=64,
+            layer_dim=1,
+            bidirectional=True,
+        ).to(device)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        criterion = nn.CrossEntropyLoss()
+        scaler = grad_scaler(device, enabled=amp)
+
+        def forward() -> torch.Tensor:
+            with autocast(device, enabled=amp):
+                return criterion(model(train_set[0][0]).float(), train_set[0][1])
+        activations = saved_activations(forward)
+
+        reset_peak_memory(device)
+        start_time = time.perf_counter()
+        for inputs, labels in train_set:
+            with autocast(device, enabled=amp):
+                loss = criterion(model(inputs).float(), labels)
+            optimizer.zero_grad()
+            scaler.scale(loss).backward()
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            scaler.step(optimizer)
+            scaler.update()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        throughput = steps * batch_size / (time.perf_counter() - start_time)
+
+        model.eval()
+        with torch.no_grad(), autocast(device, enabled=amp):
+            predictions = model(val_inputs).float().argmax(dim=1)
+        return throughput, peak_memory(device), activations, \
+            metric(predictions, val_labels).item()
+
+    results = {"fp32": run(amp=False), "amp": run(amp=True)}
+    print("{:>5} {:>12} {:>14} {:>15} {:>6}".format(
+        "", "windows/s", "peak MB", "activations MB", "F1"))
+    for name, (throughput, peak, activations, f1) in results.items():
+        print("{:>5} {:>12.1f} {:>14.1f} {:>15.1f} {:>6.3f}".format(
+            name, throughput, peak, activations, f1))
+    difference = abs(results["amp"][-1] - results["fp32"][-1])
+    assert difference <= tolerance, \
+        "AMP changes F1 by {:.3f} > {}".format(difference, tolerance)
+
+
+def test_accumulation(
+    device: torch.device = None,
+    batch_size: int = 8,
+    image_size: int = 64,
+    steps: int = 2,
+    settings: Tuple[Tuple[int, int], ...] = ((0, 0), (4, 0), (2, 0), (0, 4), (2, 4)),
+) -> None:
+    """ Memory and throughput table of a VGG11 CNN_LSTM step for several
+        (micro-batch size, checkpoint segments) settings at the same
+        effective batch size, after checking that every setting gives the
+        gradients of the whole batch, with the plain loss and with OHEM.
+        Off CUDA the peak memory is the one of the whole process.
+    """
+    from torchvision.models.vgg import VGG, make_layers, cfgs
+
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    torch.manual_seed(12345)
+    model = CNN_LSTM(
+        cnn=VGG(make_layers(cfgs["A"])),
+        input_dim=25088,
+        output_dim=2,
+        hidden_dim=64,
+        layer_dim=1,
+        bidirectional=True,
+    ).to(device)
+    # epoch 0 is the plain loss, epoch 1 keeps the hardest half of the batch
+    criterion = OHEMLoss(batch_size=batch_size // 2, init_epoch=1,
+                         criterion=nn.CrossEntropyLoss())
+    scaler = grad_scaler(device, enabled=False)
+    inputs = torch.rand((batch_size, 10, 3, image_size, image_size), device=device)
+    labels = torch.arange(batch_size, device=device) % 2
+
+    def step(micro_batch_size: int, epoch: int = 0) -> None:
+        model.zero_grad()
+        accumulate_gradients(model, inputs, labels, criterion, epoch, scaler,
+                             micro_batch_size=micro_batch_size)
+
+    references = {}
+    print("{:>6} {:>9} {:>12} {:>10} {:>15}".format(
+        "micro", "segments", "windows/s", "peak MB", "activations MB"))
+    for micro_batch_size, segments in settings:
+        model.checkpoint_segments = segments
+        for epoch in (0, 1):
+            step(micro_batch_size, epoch)
+            gradients = torch.cat([p.grad.flatten() for p in model.parameters()])
+            reference = references.setdefault(epoch, gradients)
+            assert torch.allclose(gradients, reference, rtol=1e-3, atol=1e-5), \
+                "micro-batch {} and {} segments change the gradients{}".format(
+                    micro_batch_size, segments, " of OHEM" if epoch else "")
+
+        reset_peak_memory(device)
+        start_time = time.perf_counter()
+        for _ in range(steps):
+            step(micro_batch_size)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        throughput = steps * batch_size / (time.perf_counter() - start_time)
+        # one micro-batch is alive at a time
+        activations = saved_activations(lambda: criterion(
+            model(inputs[:micro_batch_size or batch_size]), labels[:micro_batch_size or batch_size], 0))
+        print("{:>6} {:>9} {:>12.2f} {:>10.1f} {:>15.1f}".format(
+            micro_batch_size or batch_size, segments, throughput,
+            peak_memory(device), activations))
+
+
 def command_arg() -> ArgumentParser:
     parser = ArgumentParser()
     parser.add_argument('--flicker1', type=str, default="data/flicker1",
@@ -172,6 +435,36 @@ def command_arg() -> ArgumentParser:
     parser.add_argument(
         "-test", "--test", action="store_true",
         default=False, help="Whether to do testing")
+    parser.add_argument(
+        "--amp", action="store_true", default=False,
+        help="Whether to use mixed precision, float16 on CUDA and bfloat16 on CPU")
+    parser.add_argument(
+        "--test_amp", action="store_true", default=False,
+        help="Compare fp32 and AMP training on synthetic windows and exit")
+    parser.add_argument('--batch_size', type=int, default=4,
+                        help='#windows per optimizer step, half of them flicker')
+    parser.add_argument('--micro_batch_size', type=int, default=0,
+                        help='#windows per forward and backward pass, 0 for the whole batch')
+    parser.add_argument('--checkpoint_segments', type=int, default=0,
+                        help='backbone segments recomputed in the backward pass, 0 to keep every activation')
+    parser.add_argument(
+        "--test_accumulation", action="store_true", default=False,
+        help="Print the memory and throughput of micro-batch settings and exit")
+    parser.add_argument(
+        "--resume", action="store_true", default=False,
+        help="Whether to continue training from the last.pth of model_path")
+    parser.add_argument(
+        "--ddp", action="store_true", default=False,
+        help="Whether to train with DistributedDataParallel, one process per rank launched by torchrun")
+    parser.add_argument(
+        "--frozen_backbone", action="store_true", default=False,
+        help="Whether to train the temporal head only, on stored backbone features")
+    parser.add_argument('--feature_dir', type=str, default=".cache/features",
+                        help='directory of the stored backbone features')
+    parser.add_argument('--backbone', type=str, default="vgg19", choices=list(BACKBONES),
+                        help='per-frame CNN, see python3 -m mypyfunc.backbones for their costs')
+    parser.add_argument('--image_size', type=int, default=None,
+                        help='resolution the frames are resized to for the backbone, the 360 of the chunks if not given')
     return parser.parse_args()
 
 
@@ -183,6 +476,16 @@ def main() -> None:
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     init_logger()
     torch_seeding(seed=12345)
+    rank, world_size = 0, 1
+    if args.ddp:
+        rank, world_size, device = init_distributed()
+
+    if args.test_amp:
+        test_amp(device)
+        return
+    if args.test_accumulation:
+        test_accumulation(device)
+        return
 
     __cache__ = np.load(
         "{}.npz".format(cache_path), allow_pickle=True)
@@ -191,22 +494,24 @@ def main() -> None:
 
     labels = json.load(open(label_path, 'r'))
     
-    input_dim = 25088# 61952
+    cnn = Backbone(args.backbone, image_size=args.image_size)
+    input_dim = feature_dim(cnn, args.image_size or 360)
     output_dim = 2
     hidden_dim = 64
     layer_dim = 1
     bidirectional = True
-    batch_size = 4
+    batch_size = args.batch_size
     class_size = batch_size//output_dim
     max_workers = 1
     
     model = CNN_LSTM(
-        cnn=torchvision.models.vgg19(pretrained=True),
+        cnn=cnn,
         input_dim=input_dim,
         output_dim=output_dim,
         hidden_dim=hidden_dim,
         layer_dim=layer_dim,
         bidirectional=bidirectional,
+        checkpoint_segments=args.checkpoint_segments,
     )
 
     # model = CNN_Transformers(
@@ -227,13 +532,30 @@ def main() -> None:
     """
     https://stackoverflow.com/questions/59249563/runtimeerror-module-must-have-its-parameters-and-buffers-on-device-cuda1-devi
     """
-    model = torch.nn.DataParallel(model,device_ids=[1,0])
-    model.to(f'cuda:{model.device_ids[0]}')
+    if args.frozen_backbone:
+        # only the temporal head is trained, on features extracted once,
+        # frozen before DDP registers the parameters to reduce
+        model.extractor.requires_grad_(False)
+        store = FeatureStore(os.path.join(
+            args.feature_dir, "{}_{}".format(args.backbone, args.image_size or 360)))
+
+    if args.ddp:
+        # no buffers to broadcast, so that rank 0 can test on its own
+        model = nn.parallel.DistributedDataParallel(
+            model.to(device), device_ids=[device.index] if device.type == "cuda" else None,
+            broadcast_buffers=False)
+    else:
+        model = torch.nn.DataParallel(
+            model, device_ids=[1, 0] if torch.cuda.device_count() > 1 else None)
+        if model.device_ids:
+            device = torch.device(f'cuda:{model.device_ids[0]}')
+        model.to(device)
 
     optimizer = torch.optim.SGD(# try SGD
-        model.parameters(),lr=1e-3, weight_decay=1e-4,momentum=0.9)
+        [p for p in model.parameters() if p.requires_grad],lr=1e-3, weight_decay=1e-4,momentum=0.9)
     scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer,factor=0.1,patience=5,verbose=True) 
-    metric = F1Score(average='macro')
+    metric = ConfusionMatrix(output_dim, average='macro', device=device)
+    # the hardest half of every batch, ranked over all of its micro-batches
     criterion = OHEMLoss(batch_size=batch_size//2,init_epoch=40,criterion=nn.CrossEntropyLoss())  
     objective = nn.Softmax()
     epochs = 1000
@@ -250,25 +572,34 @@ def main() -> None:
                           for f in flicker_train if f in os.listdir(flicker3_path)]
         flicker4_train = [os.path.join(flicker4_path, f)
                           for f in flicker_train if f in os.listdir(flicker4_path)]
-        non_flicker_train = VideoDataSet.split_datasets(
-            non_flicker_train, labels=labels, class_size=class_size, max_workers=max_workers, undersample=1000)
-        flicker1_train = VideoDataSet.split_datasets(
-            flicker1_train+flicker2_train+flicker3_train+flicker4_train, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)  # +flicker2_train+flicker3_train+flicker4_train
-        # flicker2_train = VideoDataSet.split_datasets(
-        #     flicker2_train, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)
-        # flicker3_train = VideoDataSet.split_datasets(
-        #     flicker3_train, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)
-        # flicker4_train = VideoDataSet.split_datasets(
-        #     flicker4_train, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)
-
-        ds_train = MultiStreamer(
-            non_flicker_train,
-            flicker1_train,
-            # flicker2_train,
-            # flicker3_train,
-            # flicker4_train,
-            batch_size=batch_size,
-        )
+        flicker_train = flicker1_train+flicker2_train+flicker3_train+flicker4_train
+        if args.frozen_backbone:
+            non_flicker_train, flicker_train = non_flicker_train[rank::world_size], flicker_train[rank::world_size]
+            store.build(model.module, non_flicker_train+flicker_train, device, amp=args.amp)
+            ds_train = FeatureStreamer(
+                store, non_flicker_train, flicker_train, batch_size=batch_size, undersample=1000//world_size)
+        else:
+            non_flicker_train = VideoDataSet.split_datasets(
+                non_flicker_train, labels=labels, class_size=class_size, max_workers=max_workers, undersample=1000,
+                rank=rank, world_size=world_size)
+            flicker1_train = VideoDataSet.split_datasets(
+                flicker_train, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True,
+                rank=rank, world_size=world_size)  # +flicker2_train+flicker3_train+flicker4_train
+            # flicker2_train = VideoDataSet.split_datasets(
+            #     flicker2_train, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)
+            # flicker3_train = VideoDataSet.split_datasets(
+            #     flicker3_train, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)
+            # flicker4_train = VideoDataSet.split_datasets(
+            #     flicker4_train, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)
+
+            ds_train = MultiStreamer(
+                non_flicker_train,
+                flicker1_train,
+                # flicker2_train,
+                # flicker3_train,
+                # flicker4_train,
+                batch_size=batch_size,
+            )
         logging.info("Done loading training set")
 
         logging.info("Loading validtaion set..")
@@ -282,25 +613,34 @@ def main() -> None:
                         for f in flicker_test if f in os.listdir(flicker3_path)]
         flicker4_val = [os.path.join(flicker4_path, f)
                         for f in flicker_test if f in os.listdir(flicker4_path)]
-        non_flicker_val = VideoDataSet.split_datasets(
-            non_flicker_val, labels=labels, class_size=class_size, max_workers=max_workers, undersample=300)
-        flicker1_val = VideoDataSet.split_datasets(
-            flicker1_val+flicker2_val+flicker3_val+flicker4_val, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)  # +flicker2_val+flicker3_val+flicker4_val
-        # flicker2_val = VideoDataSet.split_datasets(
-        #     flicker2_val, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)
-        # flicker3_val = VideoDataSet.split_datasets(
-        #     flicker3_val, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)
-        # flicker4_val = VideoDataSet.split_datasets(
-        #     flicker4_val, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)
-
-        ds_val = MultiStreamer(
-            non_flicker_val,
-            flicker1_val,
-            # flicker2_val,
-            # flicker3_val,
-            # flicker4_val,
-            batch_size=batch_size,
-        )
+        flicker_val = flicker1_val+flicker2_val+flicker3_val+flicker4_val
+        if args.frozen_backbone:
+            non_flicker_val, flicker_val = non_flicker_val[rank::world_size], flicker_val[rank::world_size]
+            store.build(model.module, non_flicker_val+flicker_val, device, amp=args.amp)
+            ds_val = FeatureStreamer(
+                store, non_flicker_val, flicker_val, batch_size=batch_size, undersample=300//world_size)
+        else:
+            non_flicker_val = VideoDataSet.split_datasets(
+                non_flicker_val, labels=labels, class_size=class_size, max_workers=max_workers, undersample=300,
+                rank=rank, world_size=world_size)
+            flicker1_val = VideoDataSet.split_datasets(
+                flicker_val, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True,
+                rank=rank, world_size=world_size)  # +flicker2_val+flicker3_val+flicker4_val
+            # flicker2_val = VideoDataSet.split_datasets(
+            #     flicker2_val, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)
+            # flicker3_val = VideoDataSet.split_datasets(
+            #     flicker3_val, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)
+            # flicker4_val = VideoDataSet.split_datasets(
+            #     flicker4_val, labels=labels, class_size=class_size, max_workers=max_workers, oversample=True)
+
+            ds_val = MultiStreamer(
+                non_flicker_val,
+                flicker1_val,
+                # flicker2_val,
+                # flicker3_val,
+                # flicker4_val,
+                batch_size=batch_size,
+            )
         logging.info("Done loading validation set")
 
         logging.info(f"{model.train()}")
@@ -317,10 +657,14 @@ def main() -> None:
             epochs=epochs,
             device=device,
             save_path=model_path,
+            amp=args.amp,
+            micro_batch_size=args.micro_batch_size,
+            resume=args.resume,
         )
         logging.info("Done Training Video Model...")
 
-    if args.test:
+    # the whole test set on one process
+    if args.test and is_main_process():
         logging.info("Loading testing set..")
         non_flicker_test = [os.path.join(non_flicker_path, f)
                             for f in non_flicker_test]
@@ -332,15 +676,21 @@ def main() -> None:
                          for f in flicker_test if f in os.listdir(flicker3_path)]
         flicker4_test = [os.path.join(flicker4_path, f)
                          for f in flicker_test if f in os.listdir(flicker4_path)]
-        non_flicker_test = VideoDataSet.split_datasets(
-            non_flicker_test+flicker1_test+flicker2_test+flicker3_test+flicker4_test, labels=labels, class_size=1, max_workers=max_workers, undersample=0)#+flicker4_test
-
-
-        ds_test = MultiStreamer(
-            non_flicker_test,
-            batch_size=batch_size,
-            binary=output_dim < 3
-        )
+        all_test = non_flicker_test+flicker1_test+flicker2_test+flicker3_test+flicker4_test
+        if args.frozen_backbone:
+            store.build(model.module, all_test, device, amp=args.amp)
+            ds_test = FeatureStreamer(
+                store, all_test, batch_size=batch_size, labels=labels, binary=output_dim < 3)
+        else:
+            non_flicker_test = VideoDataSet.split_datasets(
+                all_test, labels=labels, class_size=1, max_workers=max_workers, undersample=0)#+flicker4_test
+
+
+            ds_test = MultiStreamer(
+                non_flicker_test,
+                batch_size=batch_size,
+                binary=output_dim < 3
+            )
         logging.info("Done loading testing set")
 
         logging.info("Starting Evaluation")
@@ -350,18 +700,22 @@ def main() -> None:
             objective=objective,
             device=device,
             classes=output_dim,
-            save_path=model_path
+            save_path=model_path,
+            amp=args.amp,
         )
         logging.info("Done Evaluation")
 
     del model
     torch.cuda.empty_cache()
     gc.collect()
+    if args.ddp:
+        torch.distributed.destroy_process_group()
 
 
 if __name__ == "__main__":
     """
     CUBLAS_WORKSPACE_CONFIG=:4096:8 python3 training.py --train
+    torchrun --nproc_per_node=2 training.py --train --ddp
     https://stackoverflow.com/questions/2763006/make-the-current-git-branch-a-master-branch
     """
     main()